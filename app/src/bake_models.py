@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import torch
+from batchgenerators.utilities.file_and_folder_operations import load_pickle
+from nnunet.training.model_restore import restore_model
+from bamf_nnunet_inference import get_bundle_path
+from run import get_model_paths
+
+
+def bake_fold(checkpoint_path, fold, checkpoint_name="model_final_checkpoint"):
+    """
+    Serialize the trainer class, init arguments, resolved plans and network weights of
+    one fold into a single bundle that BAMFnnUNetInference.initialize loads directly.
+    """
+    fold_dir = os.path.join(checkpoint_path, f"fold_{fold}")
+    info = load_pickle(os.path.join(fold_dir, f"{checkpoint_name}.model.pkl"))
+    # resolve the trainer class once here instead of on every container start
+    trainer = restore_model(os.path.join(fold_dir, f"{checkpoint_name}.model.pkl"), train=False)
+    checkpoint = torch.load(
+        os.path.join(fold_dir, f"{checkpoint_name}.model"), map_location=torch.device("cpu")
+    )
+    bundle = {
+        "module": trainer.__class__.__module__,
+        "name": trainer.__class__.__name__,
+        "init": info["init"],
+        "plans": trainer.plans,
+        "state_dict": checkpoint["state_dict"],
+    }
+    bundle_path = get_bundle_path(checkpoint_path, fold, checkpoint_name)
+    tmp_path = bundle_path + ".tmp"
+    torch.save(bundle, tmp_path)
+    os.replace(tmp_path, bundle_path)
+    return bundle_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bake fast-loading model bundles into the image")
+    parser.add_argument("--num_folds", type=int, default=5)
+    args = parser.parse_args()
+
+    for checkpoint_path in get_model_paths():
+        for fold_idx in range(args.num_folds):
+            print(f"baked {bake_fold(checkpoint_path, fold_idx)}")
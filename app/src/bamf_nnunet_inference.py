@@ -1,30 +1,193 @@
 from __future__ import division
 import argparse
+import importlib
 import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
 from timeit import default_timer as timer
+import pickle
 import numpy as np
-from nnunet.inference.segmentation_export import save_segmentation_nifti_from_softmax
-from nnunet.training.model_restore import load_model_and_checkpoint_files
-import nrrd
+import torch
+from nnunet.inference.segmentation_export import save_segmentation_nifti, save_segmentation_nifti_from_softmax
+from nnunet.network_architecture.neural_network import SegmentationNetwork
+from nnunet.training.model_restore import load_model_and_checkpoint_files, restore_model
 import SimpleITK as sitk
 import json
 import os
+from intermediate_store import get_export_info_path
+from io_utils import DotDict, atomic_output
 
 
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 
+# int8 kernels the fold networks are quantized for, x86 servers
+QUANTIZED_ENGINE = "fbgemm"
+
+
+def get_bundle_path(checkpoint_path, fold, checkpoint_name="model_final_checkpoint"):
+    """
+    Path of the pre-serialized trainer bundle written by bake_models.py
+    """
+    return os.path.join(checkpoint_path, f"fold_{fold}", f"{checkpoint_name}.bundle.pt")
+
+
+def load_model_bundle(bundle_path, checkpoint_path):
+    """
+    Rebuild a trainer from a bundle holding its class, init arguments, resolved plans and
+    network weights. Avoids nnUNet's search through all trainer modules and the separate
+    plans and checkpoint reads of load_model_and_checkpoint_files.
+    """
+    bundle = torch.load(bundle_path, map_location=torch.device("cpu"), weights_only=False)
+    trainer_class = getattr(importlib.import_module(bundle["module"]), bundle["name"])
+    trainer = trainer_class(*bundle["init"])
+    trainer.process_plans(bundle["plans"])
+    # same as load_model_and_checkpoint_files
+    trainer.output_folder = checkpoint_path
+    trainer.output_folder_base = checkpoint_path
+    trainer.update_fold(0)
+    trainer.initialize(False)
+    return trainer, [{"state_dict": bundle["state_dict"]}]
+
+
+def get_quantized_path(checkpoint_path, fold, checkpoint_name="model_final_checkpoint"):
+    """
+    Path of the int8 TorchScript network written by quantize_models.py
+    """
+    return os.path.join(checkpoint_path, f"fold_{fold}", f"{checkpoint_name}.int8.pt")
+
+
+def get_quantization_report_path(checkpoint_path, fold, checkpoint_name="model_final_checkpoint"):
+    """
+    Path of the Dice comparison of the int8 and fp32 networks written by quantize_models.py
+    """
+    return os.path.join(checkpoint_path, f"fold_{fold}", f"{checkpoint_name}.int8.json")
+
+
+def is_quantization_accepted(checkpoint_path, fold, max_dice_drop):
+    """
+    The int8 network of a fold may only be used when it was validated against fp32 and
+    no class lost more than max_dice_drop Dice.
+    """
+    report_path = get_quantization_report_path(checkpoint_path, fold)
+    if not os.path.isfile(get_quantized_path(checkpoint_path, fold)) or not os.path.isfile(report_path):
+        print(f"no validated int8 network for {checkpoint_path} fold {fold}, using fp32")
+        return False
+    with open(report_path, "r") as f:
+        report = json.load(f)
+    if report["max_dice_drop"] > max_dice_drop:
+        print(
+            f"int8 network for {checkpoint_path} fold {fold} loses {report['max_dice_drop']:.4f} Dice, "
+            f"more than the allowed {max_dice_drop}, using fp32"
+        )
+        return False
+    return True
+
+
+class QuantizedNetwork(SegmentationNetwork):
+    """
+    Stands in for the fp32 Generic_UNet in nnUNet's sliding window prediction, running
+    every patch through the int8 TorchScript network on the CPU.
+
+    Args:
+        network (SegmentationNetwork): fp32 network the int8 one was quantized from
+        quantized_path (str): int8 TorchScript network
+    """
+
+    def __init__(self, network, quantized_path):
+        super().__init__()
+        torch.backends.quantized.engine = QUANTIZED_ENGINE
+        self.quantized = torch.jit.load(quantized_path, map_location="cpu")
+        self.conv_op = network.conv_op
+        self.num_classes = network.num_classes
+        self.inference_apply_nonlin = network.inference_apply_nonlin
+        self.input_shape_must_be_divisible_by = network.input_shape_must_be_divisible_by
+        # traced without deep supervision
+        self.do_ds = False
+        # inference only, nnUNet's predict_3D warns about networks left in train mode
+        self.quantized.eval()
+        self.eval()
+
+    def get_device(self):
+        # int8 kernels are CPU only, the sliding window aggregation can stay on the GPU
+        return torch.cuda.current_device() if torch.cuda.is_available() else "cpu"
+
+    def forward(self, x):
+        return self.quantized(x.cpu().float()).to(x.device)
+
+
+def get_export_params(plans):
+    """
+    force_separate_z, interpolation_order and interpolation_order_z used to bring a
+    prediction back to the original CT spacing
+    """
+    if "segmentation_export_params" in plans.keys():
+        export_params = plans["segmentation_export_params"]
+        return (
+            export_params["force_separate_z"],
+            export_params["interpolation_order"],
+            export_params["interpolation_order_z"],
+        )
+    return None, 1, 0
+
+
+def save_network_segmentation(segmentation, export_info_path, output_file):
+    """
+    Resample a label map on the network grid of a task to the original CT geometry and
+    write it as nifti. Every label is resampled separately, as nnUNet does for segmentations.
+
+    Args:
+        segmentation (np.ndarray): uint8 label map on the network grid, in original axis order
+        export_info_path (str): export info written next to a fold prediction of the task
+        output_file (str): nifti file to write
+    """
+    with open(export_info_path, "rb") as f:
+        export_info = pickle.load(f)
+    with atomic_output(output_file) as tmp_output_file:
+        save_segmentation_nifti(
+            segmentation,
+            tmp_output_file,
+            export_info["properties"],
+            order=export_info["interpolation_order"],
+            force_separate_z=export_info["force_separate_z"],
+            order_z=export_info["interpolation_order_z"],
+        )
+
+
 class BAMFnnUNetInference:
+    def __init__(self):
+        self.trainer = None
+        self.model_key = None
+
+    def is_initialized(self, context):
+        return self.model_key == (str(context.checkpoint_path), int(context.fold), bool(context.quantized))
+
     def initialize(self, context):
-        self.trainer, self.params = load_model_and_checkpoint_files(
-            context.checkpoint_path,
-            context.fold,
-            checkpoint_name="model_final_checkpoint",
-        )
+        if self.is_initialized(context):
+            # weights for this task/fold are already resident, nothing to reload
+            self.context = context
+            return
+        bundle_path = get_bundle_path(context.checkpoint_path, context.fold)
+        if context.use_bundle is not False and os.path.isfile(bundle_path):
+            self.trainer, self.params = load_model_bundle(bundle_path, context.checkpoint_path)
+        else:
+            self.trainer, self.params = load_model_and_checkpoint_files(
+                context.checkpoint_path,
+                context.fold,
+                checkpoint_name="model_final_checkpoint",
+            )
         self.trainer.initialize_network()
         self.trainer.network.load_state_dict(self.params[0]["state_dict"])
+        if context.quantized and is_quantization_accepted(
+            context.checkpoint_path, context.fold, context.max_dice_drop or 0.0
+        ):
+            self.trainer.network = QuantizedNetwork(
+                self.trainer.network, get_quantized_path(context.checkpoint_path, context.fold)
+            )
         self.mirror_axes = self.trainer.data_aug_params["mirror_axes"]
+        self.model_key = (str(context.checkpoint_path), int(context.fold), bool(context.quantized))
         self.context = context
 
     def preprocess(self):
@@ -37,6 +200,13 @@ class BAMFnnUNetInference:
         return data
 
     def inference(self, data):
+        if self.context.accumulator_dtype and not self.context.predict_aug:
+            # same sliding window, with accumulators of the precision the memory plan chose
+            from batch_inference import predict_batched
+
+            return predict_batched(
+                self, [data], 1, dtype=self.context.accumulator_dtype, spill_dir=self.context.spill_dir
+            )[0]
         results = self.trainer.predict_preprocessed_data_return_seg_and_softmax(
             data, do_mirroring=self.context.predict_aug, mirror_axes=self.mirror_axes
         )[1]
@@ -46,6 +216,8 @@ class BAMFnnUNetInference:
         """
         labels : path to user defined json file with segment names and other metadata
         """
+        import nrrd
+
         # print(self.output_file)
         img = sitk.ReadImage(self.output_file)
         op_path = self.output_file.replace(".nii.gz", ".seg.nrrd")
@@ -61,44 +233,47 @@ class BAMFnnUNetInference:
         self.output_dir = os.path.join(os.path.join(self.context.prediction_save))
         if not os.path.isdir(self.output_dir):
             os.mkdir(self.output_dir)
+        force_separate_z, interpolation_order, interpolation_order_z = get_export_params(self.trainer.plans)
+        pred = data.transpose([0] + [i + 1 for i in self.trainer.transpose_backward])
+
+        if self.context.network_space:
+            # keep the argmax on the network grid, the folds are ensembled there and
+            # resampled to the CT geometry once per task by save_network_segmentation
+            self.output_file = os.path.join(self.output_dir, self.context.organ_name + ".npy")
+            with atomic_output(self.output_file) as tmp_output_file:
+                with open(tmp_output_file, "wb") as f:
+                    np.save(f, pred.argmax(0).astype(np.uint8))
+            with atomic_output(get_export_info_path(self.output_file)) as tmp_output_file:
+                with open(tmp_output_file, "wb") as f:
+                    pickle.dump({
+                        "properties": self.properties,
+                        "force_separate_z": force_separate_z,
+                        "interpolation_order": interpolation_order,
+                        "interpolation_order_z": interpolation_order_z,
+                    }, f)
+            return self.output_file
+
         self.output_file = os.path.join(
-            self.output_dir, self.context.organ_name + ".nii.gz"
+            self.output_dir, self.context.organ_name + (self.context.output_ext or ".nii.gz")
         )
         # optional
         softmax_ouput_file = os.path.join(self.output_dir, "temp_softmax")
+        with atomic_output(self.output_file) as tmp_output_file:
+            save_segmentation_nifti_from_softmax(
+                pred,
+                tmp_output_file,
+                self.properties,
+                interpolation_order,
+                self.trainer.regions_class_order,
+                None,
+                None,
+                softmax_ouput_file,
+                None,
+                force_separate_z=force_separate_z,
+                interpolation_order_z=interpolation_order_z,
+            )
 
-        if "segmentation_export_params" in self.trainer.plans.keys():
-            force_separate_z = self.trainer.plans["segmentation_export_params"][
-                "force_separate_z"
-            ]
-            interpolation_order = self.trainer.plans["segmentation_export_params"][
-                "interpolation_order"
-            ]
-            interpolation_order_z = self.trainer.plans["segmentation_export_params"][
-                "interpolation_order_z"
-            ]
-        else:
-            force_separate_z = None
-            interpolation_order = 1
-            interpolation_order_z = 0
-        pred = data.transpose([0] + [i + 1 for i in self.trainer.transpose_backward])
-        save_segmentation_nifti_from_softmax(
-            pred,
-            self.output_file,
-            self.properties,
-            interpolation_order,
-            self.trainer.regions_class_order,
-            None,
-            None,
-            softmax_ouput_file,
-            None,
-            force_separate_z=force_separate_z,
-            interpolation_order_z=interpolation_order_z,
-        )
-
-        results = pred.tolist()
-
-        return results
+        return self.output_file
 
     def handle(self, context):
         """Entry point for default handler. It takes the data from the input request and returns
@@ -113,6 +288,8 @@ class BAMFnnUNetInference:
         self.context = context
         self.initialize(context)
         data_preprocess = self.preprocess()
+        if context.on_inference_start:
+            context.on_inference_start()
         inferred = self.inference(data_preprocess)
         output = self.postprocess(inferred)
         print("converting to seg.nrrd..")
@@ -123,6 +300,79 @@ class BAMFnnUNetInference:
         return [{"Predicition": "Done", "Pred Path": self.output_dir}]
 
 
+def preprocess_for_task(checkpoint_path, input_file, fold=0):
+    """
+    Run the nnUNet preprocessing of a task without loading any network weights. All folds
+    of a task share the same plans, so the result can be reused for every fold.
+
+    Args:
+        checkpoint_path (str): nnUNet model folder of the task
+        input_file (str): path to input CT file
+        fold (int, optional): fold whose plans are used. Default is 0.
+
+    Returns:
+        tuple: preprocessed data and the nnUNet properties needed to export the prediction
+    """
+    trainer = restore_model(
+        os.path.join(checkpoint_path, f"fold_{fold}", "model_final_checkpoint.model.pkl"),
+        train=False,
+    )
+    data, s, properties = trainer.preprocess_patient([str(input_file)])
+    return data, properties
+
+
+class BAMFnnUNetModelCache:
+    """
+    Keeps initialized fold models around so they can be reused across runs.
+
+    Args:
+        max_models (int, optional): Number of fold models kept resident. The least recently
+            used model is dropped once the limit is exceeded. None keeps every model loaded.
+    """
+
+    def __init__(self, max_models=None):
+        self.max_models = max_models
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get_entry(self, checkpoint_path, fold):
+        key = (str(checkpoint_path), int(fold))
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+            entry = (BAMFnnUNetInference(), threading.Lock())
+            self.models[key] = entry
+            while self.max_models is not None and len(self.models) > self.max_models:
+                self.models.popitem(last=False)
+            return entry
+
+    @contextmanager
+    def acquire(self, checkpoint_path, fold):
+        """
+        Borrow the model for a task/fold. Models keep per-call state, so concurrent
+        callers asking for the same task/fold are serialized.
+        """
+        model, model_lock = self._get_entry(checkpoint_path, fold)
+        with model_lock:
+            yield model
+
+    def preload(self, checkpoint_paths, num_folds, use_bundle=True, quantized=False, max_dice_drop=None):
+        """
+        Load every fold of every checkpoint up front, the way the jobs will initialize them.
+        """
+        for checkpoint_path in checkpoint_paths:
+            for fold_idx in range(num_folds):
+                with self.acquire(checkpoint_path, fold_idx) as model:
+                    model.initialize(DotDict({
+                        "checkpoint_path": checkpoint_path,
+                        "fold": fold_idx,
+                        "use_bundle": use_bundle,
+                        "quantized": quantized,
+                        "max_dice_drop": max_dice_drop,
+                    }))
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument(
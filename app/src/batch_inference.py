@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+import argparse
+import itertools
+import os
+import tempfile
+from pathlib import Path
+from timeit import default_timer as timer
+import numpy as np
+from dicom_index import get_dicom_index
+from intermediate_store import write_geometry_sidecar
+from io_utils import DotDict, StageTimer, atomic_output, get_lesion_table_path, get_path
+from run import ensemble_on_network_grid, export_seg, get_runner_args, get_tasks, load_config
+
+# torch, nnunet and SimpleITK are imported by the functions that use them, not at module
+# level: the spawned header readers of the dicom index re-import this module
+
+
+def cast_importance_map(gaussian, dtype):
+    """
+    The tile importance map in the accumulator precision. The corners of nnUNet's gaussian
+    underflow to 0 in float16, which would leave voxels covered only by tile corners with
+    no weight, so zeros are raised to the smallest non-zero value as nnUNet does for fp16.
+    """
+    gaussian = gaussian.astype(dtype)
+    gaussian[gaussian == 0] = gaussian[gaussian != 0].min()
+    return gaussian
+
+
+class TileAggregator:
+    """
+    Gaussian weighted sum of the tile predictions of one preprocessed series, the same
+    sliding window nnUNet runs in predict_preprocessed_data_return_seg_and_softmax.
+
+    Args:
+        data (np.ndarray): preprocessed series (c, x, y, z)
+        patch_size (tuple): network input size
+        num_classes (int): number of network output channels
+        gaussian (np.ndarray): importance map of a tile, see cast_importance_map
+        step_size (float, optional): distance between tiles as a fraction of the patch size
+        dtype (str, optional): precision of the accumulators
+        spill_dir (str, optional): keep the accumulators in memory-mapped files in this dir
+    """
+
+    def __init__(self, data, patch_size, num_classes, gaussian, step_size=0.5, dtype="float32", spill_dir=None):
+        from batchgenerators.augmentations.utils import pad_nd_image
+        from nnunet.network_architecture.neural_network import SegmentationNetwork
+
+        self.data, self.slicer = pad_nd_image(data, patch_size, "constant", {"constant_values": 0}, True, None)
+        self.dtype = np.dtype(dtype)
+        self.gaussian = cast_importance_map(gaussian, self.dtype)
+        shape = self.data.shape[1:]
+        steps = SegmentationNetwork._compute_steps_for_sliding_window(patch_size, shape, step_size)
+        self.tiles = [
+            tuple(slice(lb, lb + p) for lb, p in zip(lbs, patch_size)) for lbs in itertools.product(*steps)
+        ]
+        self.spill_dir = spill_dir
+        self.aggregated = self._zeros((num_classes, *shape))
+        self.weights = self._zeros(shape)
+
+    def _zeros(self, shape):
+        if self.spill_dir is None:
+            return np.zeros(shape, dtype=self.dtype)
+        return np.memmap(tempfile.TemporaryFile(dir=self.spill_dir), dtype=self.dtype, mode="w+", shape=shape)
+
+    def get_tile(self, tile):
+        return self.data[(slice(None), *tile)]
+
+    def add(self, tile, prediction):
+        """Add the gaussian weighted softmax of a tile"""
+        self.aggregated[(slice(None), *tile)] += prediction.astype(self.dtype, copy=False)
+        self.weights[tile] += self.gaussian
+
+    def softmax(self):
+        """
+        Class probabilities (c, x, y, z) on the unpadded grid, as returned by BAMFnnUNetInference.inference
+        """
+        crop = tuple(self.slicer[1:])
+        softmax = np.empty((len(self.aggregated), *self.weights[crop].shape), dtype=self.dtype)
+        # one class at a time, so no float64 temporary of the whole volume is made
+        for c in range(len(self.aggregated)):
+            np.divide(self.aggregated[(c, *crop)], self.weights[crop], out=softmax[c])
+        return softmax
+
+
+def predict_batched(model, volumes, batch_size, step_size=0.5, dtype="float32", spill_dir=None):
+    """
+    Sliding window prediction of one fold network over several preprocessed series.
+    Tiles of different series are packed into shared forward batches, so small scans
+    don't leave the last batches of every series partly empty.
+
+    Args:
+        model (BAMFnnUNetInference): initialized model of the fold
+        volumes (list): preprocessed series (c, x, y, z)
+        batch_size (int): tiles per forward pass
+        step_size (float, optional): distance between tiles as a fraction of the patch size
+        dtype (str, optional): precision of the accumulators
+        spill_dir (str, optional): keep the accumulators in memory-mapped files in this dir
+
+    Returns:
+        list: class probabilities of each series
+    """
+    import torch
+    from nnunet.network_architecture.neural_network import SegmentationNetwork
+
+    network = model.trainer.network
+    patch_size = tuple(int(x) for x in model.trainer.patch_size)
+    # tiles are weighted with the importance map the aggregators sum, in their precision
+    gaussian = cast_importance_map(SegmentationNetwork._get_gaussian(patch_size, sigma_scale=1. / 8), dtype)
+    aggregators = [
+        TileAggregator(data, patch_size, network.num_classes, gaussian, step_size, dtype=dtype, spill_dir=spill_dir)
+        for data in volumes
+    ]
+    tiles = [(aggregator, tile) for aggregator in aggregators for tile in aggregator.tiles]
+
+    device = torch.device("cpu") if network.get_device() == "cpu" else torch.device("cuda", network.get_device())
+    gaussian_torch = torch.from_numpy(gaussian.astype(np.float32)).to(device)
+    do_ds = network.do_ds
+    network.do_ds = False
+    network.eval()
+    try:
+        with torch.no_grad(), torch.autocast("cuda", enabled=device.type == "cuda" and model.trainer.fp16):
+            for start in range(0, len(tiles), batch_size):
+                batch = tiles[start:start + batch_size]
+                x = torch.from_numpy(np.stack([aggregator.get_tile(tile) for aggregator, tile in batch]))
+                pred = network.inference_apply_nonlin(network(x.float().to(device))).float()
+                pred = (pred * gaussian_torch).cpu().numpy()
+                for (aggregator, tile), tile_pred in zip(batch, pred):
+                    aggregator.add(tile, tile_pred)
+    finally:
+        network.do_ds = do_ds
+    return [aggregator.softmax() for aggregator in aggregators]
+
+
+def convert_series(source_ct_dir, job_dir, intermediate_ext):
+    """
+    Convert one dicom series to the CT intermediate of its job dir. Returns the CT path,
+    its geometry and the ordered files of the series, None if it is the only series in
+    source_ct_dir.
+    """
+    from converter_utils import DicomToNiiConverter
+
+    ct_path = get_path(job_dir, "nii-input", f"ct_0000{intermediate_ext}")
+    dicom_index = get_dicom_index(source_ct_dir, job_dir)
+    series_uid = dicom_index.primary_series_uid()
+    converter = DicomToNiiConverter()
+    with atomic_output(ct_path) as tmp_ct_path:
+        if not converter.dcm_to_nii(source_ct_dir, tmp_ct_path, dicom_index=dicom_index, series_uid=series_uid):
+            raise RuntimeError(f"failed to convert {source_ct_dir} to nifti")
+    write_geometry_sidecar(ct_path, converter.geometry)
+    dcm_files = dicom_index.files(series_uid) if len(dicom_index.series()) > 1 else None
+    return ct_path, converter.geometry, dcm_files
+
+
+def run_batch(
+        series_dirs,
+        target_root,
+        runner_args,
+        work_dir="/tmp/aimi-batch",
+        tile_batch_size=4,
+        series_per_group=8,
+        model_cache=None,
+        stage_timer=None
+        ):
+    """
+    Segment many series, inferring each fold network once per group of series with
+    tiles of the whole group packed into shared batches.
+
+    :param: series_dirs - dirs each containing the dcm files of one series
+    :param: target_root - outputs of each series are written to target_root/<series dir name>
+    :param: runner_args - NNUnetRunner arguments, as returned by get_runner_args
+    :param: work_dir - scratch dir, one sub dir per series
+    :param: tile_batch_size - tiles per forward pass
+    :param: series_per_group - series whose predictions are held in memory at the same time
+    :param: model_cache - BAMFnnUNetModelCache holding already loaded fold models
+    :param: stage_timer - StageTimer collecting per-stage timings
+    :return: dict of per-stage timings in seconds
+    """
+    # the job dir and the target dir of a series are named after its dir
+    names = [os.path.basename(os.path.normpath(x)) for x in series_dirs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"series dirs must have distinct names, found duplicates: {duplicates}")
+
+    from bamf_nnunet_inference import BAMFnnUNetModelCache, preprocess_for_task
+    from lung_processor import LungPostProcessor
+
+    stage_timer = stage_timer if stage_timer is not None else StageTimer()
+    model_cache = model_cache if model_cache is not None else BAMFnnUNetModelCache(max_models=1)
+    num_folds = runner_args["num_folds"]
+    organ_label = runner_args["organ_label"]
+    intermediate_ext = f".{runner_args['intermediate_format']}"
+    network_space = runner_args["ensemble_space"] == "network"
+    tasks = get_tasks()
+    start = timer()
+
+    for group_start in range(0, len(series_dirs), series_per_group):
+        jobs = []
+        with stage_timer.stage("dcm_to_nii"):
+            for source_ct_dir, name in zip(
+                    series_dirs[group_start:group_start + series_per_group],
+                    names[group_start:group_start + series_per_group]
+                    ):
+                job_dir = get_path(work_dir, name)
+                folds_dir = get_path(job_dir, "folds")
+                Path(folds_dir).mkdir(parents=True, exist_ok=True)
+                ct_path, geometry, dcm_files = convert_series(source_ct_dir, job_dir, intermediate_ext)
+                jobs.append(DotDict({
+                    "name": name,
+                    "source_ct_dir": source_ct_dir,
+                    "ct_path": ct_path,
+                    "geometry": geometry,
+                    "dcm_files": dcm_files,
+                    "folds_dir": folds_dir,
+                }))
+
+        for _, checkpoint_path, organ_name_prefix, _ in tasks:
+            with stage_timer.stage("preprocess"):
+                preprocessed = [preprocess_for_task(checkpoint_path, job.ct_path) for job in jobs]
+            for fold_idx in range(num_folds):
+                context = DotDict({
+                    "checkpoint_path": checkpoint_path,
+                    "fold": fold_idx,
+                    "predict_aug": False,
+                    "use_bundle": runner_args["use_model_bundles"],
+                    "quantized": runner_args["precision"] == "int8",
+                    "max_dice_drop": runner_args["int8_max_dice_drop"],
+                })
+                with model_cache.acquire(checkpoint_path, fold_idx) as model:
+                    model.initialize(context)
+                    with stage_timer.stage("infer"):
+                        softmaxes = predict_batched(model, [data for data, _ in preprocessed], tile_batch_size)
+                    with stage_timer.stage("export_folds"):
+                        for job, (_, properties), softmax in zip(jobs, preprocessed, softmaxes):
+                            model.context = DotDict(
+                                context,
+                                prediction_save=job.folds_dir,
+                                organ_name=f"{organ_name_prefix}_{fold_idx}",
+                                output_ext=intermediate_ext,
+                                network_space=network_space,
+                            )
+                            model.properties = properties
+                            model.postprocess(softmax)
+                del softmaxes
+
+        organ_name_nodules_prefix, organ_name_nsclc_rg_prefix = [prefix for _, _, prefix, _ in tasks]
+        lung_post_processor = LungPostProcessor()
+        for job in jobs:
+            with stage_timer.stage("postprocessing"):
+                if network_space:
+                    for _, _, organ_name_prefix, is_nodules in tasks:
+                        ensemble_on_network_grid(
+                            job.folds_dir, organ_name_prefix, is_nodules, organ_label, num_folds, intermediate_ext
+                            )
+                output_nodules_seg_path = get_path(job.folds_dir, runner_args["output_nodules_seg_name"])
+                output_lesions_seg_path = get_path(job.folds_dir, runner_args["output_lesions_seg_name"])
+                # job dirs are reused across runs, and postprocessing keeps masks that already exist
+                for seg_path in [output_nodules_seg_path, output_lesions_seg_path]:
+                    for path in [seg_path, get_lesion_table_path(seg_path, "json"), get_lesion_table_path(seg_path, "csv")]:
+                        if os.path.isfile(path):
+                            os.remove(path)
+                lung_post_processor.postprocessing(
+                    save_path=job.folds_dir,
+                    ct_path=job.ct_path,
+                    output_nodules_seg_path=output_nodules_seg_path,
+                    output_lesions_seg_path=output_lesions_seg_path,
+                    organ_name_nodules_prefix=organ_name_nodules_prefix,
+                    organ_name_nsclc_rg_prefix=organ_name_nsclc_rg_prefix,
+                    lung_label=organ_label,
+                    num_folds=num_folds,
+                    ct_geometry=job.geometry,
+                    fold_ext=intermediate_ext,
+                    network_ensemble=network_space
+                    )
+            with stage_timer.stage("export"):
+                target_dir = get_path(target_root, job.name)
+                Path(target_dir).mkdir(parents=True, exist_ok=True)
+                for seg_path, seg_name in [
+                    (output_nodules_seg_path, runner_args["output_nodules_seg_name"]),
+                    (output_lesions_seg_path, runner_args["output_lesions_seg_name"]),
+                ]:
+                    export_seg(seg_path, seg_name, job.source_ct_dir, target_dir, dcm_ref_files=job.dcm_files)
+
+    elapsed = timer() - start
+    print(f"segmented {len(series_dirs)} series in {elapsed:.1f}s ({elapsed / max(1, len(series_dirs)):.1f}s per series)")
+    return stage_timer.timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Segment many series with tiles batched across series")
+    parser.add_argument("source_root", help="dir with one sub dir of dcm files per series")
+    parser.add_argument("target_root", help="outputs of each series go to a sub dir of the same name")
+    parser.add_argument("--config", default="default.yml", help="Path to the YAML configuration file")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    batch_config = config.get("modules", {}).get("BatchInference", {})
+    series_dirs = sorted(
+        str(x) for x in Path(args.source_root).iterdir() if x.is_dir() and not x.name.startswith(".")
+    )
+    run_batch(
+        series_dirs,
+        args.target_root,
+        get_runner_args(config),
+        work_dir=batch_config.get("work_dir", "/tmp/aimi-batch"),
+        tile_batch_size=int(batch_config.get("tile_batch_size", 4)),
+        series_per_group=int(batch_config.get("series_per_group", 8)),
+    )
@@ -1,18 +1,20 @@
 #!/usr/bin/env python3
 import argparse
+import contextlib
 import shutil
 import subprocess
 from pathlib import Path
 from tempfile import TemporaryDirectory
-import pydicom
 import SimpleITK as sitk
 import os
-from fix_dicom import fix_dicom_dir
+from dicom_index import DicomIndex
+from io_utils import DotDict
 
 
 class DicomToNiiConverter:
     def __init__(self) -> None:
-        pass
+        # geometry of the last converted series, so later stages don't have to re-read the nifti
+        self.geometry = None
 
     def dcm_to_niix(self, dcm_dir: Path, nii_path: Path):
         """uses dcm2niix to convert a series of dicom files to a nifti file"""
@@ -45,38 +47,38 @@ class DicomToNiiConverter:
             raise ValueError(f"Expected 1 *.nii.gz file, found 0")
 
 
-    def dcm_to_nii(self, dcm_dir: Path, nii_path: Path) -> bool:
+    def dcm_to_nii(self, dcm_dir: Path, nii_path: Path, dicom_index: DicomIndex = None, series_uid: str = None) -> bool:
         """uses SimpleITK to convert a series of dicom files to a nifti file"""
-        # sort the files to hopefully make conversion a bit more reliable
-        files = []
-        dcm_dir = Path(dcm_dir)
         nii_path = Path(nii_path)
-        for f in dcm_dir.glob("*.dcm"):
-            ds = pydicom.dcmread(f, stop_before_pixels=True)
-            slicer_loc = ds.SliceLocation if hasattr(ds, "SlicerLocation") else 0
-            files.append((slicer_loc, f))
-        slices = sorted(files, key=lambda s: s[0])
-        ordered_files = [x[1] for x in slices]
-
-        with TemporaryDirectory() as tmp_dir:
-            ptmp_dir = Path(tmp_dir)
-            for i, f in enumerate(ordered_files):
-                shutil.copy(f, ptmp_dir / f"{i}.dcm")
-            try:
-                # load in with SimpleITK
-                reader = sitk.ImageSeriesReader()
-                dicom_names = reader.GetGDCMSeriesFileNames(tmp_dir)
-                reader.SetFileNames(dicom_names)
-                image = reader.Execute()
-
-                nii_path.parent.mkdir(parents=True, exist_ok=True)
-                # save as nifti
-                sitk.WriteImage(
-                    image, str(nii_path.resolve()), useCompression=True, compressionLevel=9
-                )
-            except:
-                return False
-            return True
+        try:
+            if dicom_index is None:
+                dicom_index = DicomIndex(dcm_dir)
+            if series_uid is None:
+                series_uid = dicom_index.primary_series_uid()
+            # the index already holds the series in slice order, no need for GDCM to rescan it
+            ordered_files = dicom_index.files(series_uid)
+
+            # load in with SimpleITK
+            reader = sitk.ImageSeriesReader()
+            reader.SetFileNames(ordered_files)
+            image = reader.Execute()
+            self.geometry = DotDict({
+                "spacing": image.GetSpacing(),
+                "origin": image.GetOrigin(),
+                "direction": image.GetDirection(),
+            })
+
+            nii_path.parent.mkdir(parents=True, exist_ok=True)
+            # save as nifti
+            sitk.WriteImage(
+                image,
+                str(nii_path.resolve()),
+                useCompression=nii_path.name.endswith(".gz"),
+                compressionLevel=9,
+            )
+        except:
+            return False
+        return True
 
 
 class NiiToDicomConverter:
@@ -91,51 +93,60 @@ class NiiToDicomConverter:
             dcm_out_file: Path,
             dicom_seg_meta_json: Path,
             add_background_label: bool = False,
+            dcm_ref_files: list = None,
             ):
         
         assert dcm_ref_dir.exists(), dcm_ref_dir
 
-        dcm_out_file = Path(dcm_out_file)
-        dcm_out_file.parent.mkdir(parents=True, exist_ok=True)
-
-        if add_background_label:
-            # add background label, offset by 1
-            with TemporaryDirectory() as temp_dir:
-                temp_seg_file = Path(temp_dir) / "temp_seg.nii.gz"
-                img = sitk.ReadImage(str(nii_path))
-                img += 1
-                sitk.WriteImage(img, str(temp_seg_file))
-
+        with contextlib.ExitStack() as stack:
+            if dcm_ref_files:
+                # dcmqi only sees the files of the referenced series, linked into a dir of their
+                # own. A --inputDICOMList of a thin-slice series is longer than the kernel allows
+                # a single argument to be
+                dcm_ref_dir = Path(stack.enter_context(TemporaryDirectory()))
+                for i, dcm_file in enumerate(dcm_ref_files):
+                    os.symlink(os.path.abspath(dcm_file), dcm_ref_dir / f"{i:06d}.dcm")
+            dicom_args = ["--inputDICOMDirectory", str(dcm_ref_dir)]
+
+            dcm_out_file = Path(dcm_out_file)
+            dcm_out_file.parent.mkdir(parents=True, exist_ok=True)
+
+            if add_background_label:
+                # add background label, offset by 1
+                with TemporaryDirectory() as temp_dir:
+                    temp_seg_file = Path(temp_dir) / "temp_seg.nii.gz"
+                    img = sitk.ReadImage(str(nii_path))
+                    img += 1
+                    sitk.WriteImage(img, str(temp_seg_file))
+
+                    args = [
+                        self.itkimage2segimage_bin,
+                        "--skip",
+                        "--inputImageList",
+                        str(temp_seg_file),
+                        *dicom_args,
+                        "--outputDICOM",
+                        str(dcm_out_file),
+                        "--inputMetadata",
+                        str(dicom_seg_meta_json),
+                    ]
+
+                    subprocess.run(args, check=True)
+            else:
                 args = [
                     self.itkimage2segimage_bin,
                     "--skip",
                     "--inputImageList",
-                    str(temp_seg_file),
-                    "--inputDICOMDirectory",
-                    str(dcm_ref_dir),
+                    str(nii_path),
+                    *dicom_args,
                     "--outputDICOM",
                     str(dcm_out_file),
                     "--inputMetadata",
                     str(dicom_seg_meta_json),
                 ]
 
+                print(" ".join(args))
                 subprocess.run(args, check=True)
-        else:
-            args = [
-                self.itkimage2segimage_bin,
-                "--skip",
-                "--inputImageList",
-                str(nii_path),
-                "--inputDICOMDirectory",
-                str(dcm_ref_dir),
-                "--outputDICOM",
-                str(dcm_out_file),
-                "--inputMetadata",
-                str(dicom_seg_meta_json),
-            ]
-
-            print(" ".join(args))
-            subprocess.run(args, check=True)
 
     def convert_nii_to_dcm(
             self,
@@ -143,17 +154,19 @@ class NiiToDicomConverter:
             dcm_ref_dir: Path,
             dcm_out_file: Path,
             dicom_seg_meta_json: Path,
-            add_background_label: bool = False
+            add_background_label: bool = False,
+            dcm_ref_files: list = None,
             ):
         
         status = True
         try:
-            self._convert_to_dicom_seg(
+            self._convert_nii_to_dcm(
                 nii_path,
                 dcm_ref_dir,
                 dcm_out_file,
                 dicom_seg_meta_json,
-                add_background_label=add_background_label
+                add_background_label=add_background_label,
+                dcm_ref_files=dcm_ref_files,
             )
         except Exception as e:
             status = False
@@ -163,9 +176,10 @@ class NiiToDicomConverter:
             return
 
         # # fix the dicom files, and try again
+        # from fix_dicom import fix_dicom_dir
         # with TemporaryDirectory() as fixed_dcm_dir:
-        #     real_dcm_dir = fix_dicom_dir(dcm_ref_dir, Path(fixed_dcm_dir))
-        #     self._convert_to_dicom_seg(
+        #     real_dcm_dir = fix_dicom_dir(dcm_ref_dir, Path(fixed_dcm_dir), dcm_files=dcm_ref_files)
+        #     self._convert_nii_to_dcm(
         #         nii_path,
         #         real_dcm_dir,
         #         dcm_out_file,
@@ -194,4 +208,4 @@ if __name__ == "__main__":
     if args.niix:
         converter.dcm_to_niix(args.dcm_dir, args.nii_path)
     else:
-        converter.dcm_to_nii*(args.dcm_dir, args.nii_path)
+        converter.dcm_to_nii(args.dcm_dir, args.nii_path)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from io_utils import DotDict, get_path
+
+
+# below this many files the headers are read in-process, a pool costs more than it saves
+MIN_PARALLEL_FILES = 64
+
+INSTANCE_COLUMNS = [
+    "path",
+    "size",
+    "mtime_ns",
+    "series_uid",
+    "study_uid",
+    "sop_instance_uid",
+    "sop_class_uid",
+    "modality",
+    "series_description",
+    "instance_number",
+    "position",
+    "orientation",
+    "pixel_spacing",
+    "slice_thickness",
+    "rows",
+    "columns",
+    "slice_position",
+    "pixel_data_offset",
+]
+
+# multi-valued columns, stored as json
+JSON_COLUMNS = ["position", "orientation", "pixel_spacing"]
+
+
+def _get_values(ds, keyword):
+    value = ds.get(keyword)
+    if value is None:
+        return None
+    return [float(x) for x in value]
+
+
+def _read_header(path):
+    """
+    Read the header of one file up to the pixel data. Returns None for files that are
+    not dicom or have no SeriesInstanceUID.
+    """
+    import pydicom
+
+    stat = os.stat(path)
+    try:
+        with open(path, "rb") as fp:
+            ds = pydicom.dcmread(fp, stop_before_pixels=True)
+            # dcmread rewinds to the start of the pixel data element before stopping
+            pixel_data_offset = fp.tell()
+    except Exception:
+        return None
+    if "SeriesInstanceUID" not in ds:
+        return None
+
+    position = _get_values(ds, "ImagePositionPatient")
+    orientation = _get_values(ds, "ImageOrientationPatient")
+    slice_position = None
+    if position is not None and orientation is not None and len(orientation) == 6:
+        # distance along the slice normal, the order GDCM sorts a series in
+        normal = np.cross(orientation[:3], orientation[3:])
+        slice_position = float(np.dot(normal, position))
+    instance_number = ds.get("InstanceNumber")
+    slice_thickness = ds.get("SliceThickness")
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "series_uid": str(ds.SeriesInstanceUID),
+        "study_uid": str(ds.get("StudyInstanceUID", "")),
+        "sop_instance_uid": str(ds.get("SOPInstanceUID", "")),
+        "sop_class_uid": str(ds.get("SOPClassUID", "")),
+        "modality": str(ds.get("Modality", "")),
+        "series_description": str(ds.get("SeriesDescription", "")),
+        "instance_number": int(instance_number) if instance_number not in (None, "") else None,
+        "position": position,
+        "orientation": orientation,
+        "pixel_spacing": _get_values(ds, "PixelSpacing"),
+        "slice_thickness": float(slice_thickness) if slice_thickness not in (None, "") else None,
+        "rows": ds.get("Rows"),
+        "columns": ds.get("Columns"),
+        "slice_position": slice_position,
+        "pixel_data_offset": pixel_data_offset if pixel_data_offset < stat.st_size else None,
+    }
+
+
+def _read_headers(paths, max_workers=None):
+    """
+    Read the headers of many files, on a process pool for large directories
+    """
+    if max_workers is None:
+        max_workers = min(8, os.cpu_count() or 1)
+    if max_workers <= 1 or len(paths) < MIN_PARALLEL_FILES:
+        return [_read_header(path) for path in paths]
+    chunksize = max(1, len(paths) // (max_workers * 4))
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp.get_context("spawn")) as executor:
+        return list(executor.map(_read_header, paths, chunksize=chunksize))
+
+
+def list_files(dcm_dir):
+    """
+    All files under dcm_dir with their size and mtime, keyed by path relative to dcm_dir
+    """
+    files = {}
+    for root, dirs, names in os.walk(dcm_dir):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in names:
+            if name.startswith("."):
+                continue
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            files[os.path.relpath(path, dcm_dir)] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+class DicomIndex:
+    """
+    Header index of the dicom files under a directory, persisted in SQLite. Maps each series
+    to its instances ordered along the slice normal, with their geometry, SOP UIDs and the
+    file offset of the pixel data. Opening an existing index only re-reads the files that
+    were added or changed since it was written.
+
+    Args:
+        dcm_dir (str): directory of dicom files, searched recursively
+        index_path (str, optional): SQLite file to persist the index in, in memory by default
+        max_workers (int, optional): processes used to read headers
+    """
+
+    def __init__(self, dcm_dir, index_path=":memory:", max_workers=None):
+        self.dcm_dir = os.path.abspath(dcm_dir)
+        self.index_path = str(index_path)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.index_path, check_same_thread=False)
+        columns = ", ".join(
+            f"{column} TEXT PRIMARY KEY" if column == "path" else column for column in INSTANCE_COLUMNS
+        )
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS instances ({columns})")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS instances_series "
+            "ON instances (series_uid, slice_position, instance_number)"
+        )
+        self.conn.commit()
+        self.refresh(max_workers=max_workers)
+
+    def refresh(self, max_workers=None):
+        """
+        Bring the index in line with the directory. Returns the number of files read.
+        """
+        files = list_files(self.dcm_dir)
+        with self.lock:
+            indexed = {
+                path: (size, mtime_ns)
+                for path, size, mtime_ns in self.conn.execute("SELECT path, size, mtime_ns FROM instances")
+            }
+        removed = [path for path in indexed if path not in files]
+        changed = [path for path, stat in files.items() if indexed.get(path) != stat]
+        headers = _read_headers([os.path.join(self.dcm_dir, path) for path in changed], max_workers)
+
+        rows = []
+        for path, header in zip(changed, headers):
+            if header is None:
+                # remember non-dicom files too, so they are not read again
+                size, mtime_ns = files[path]
+                header = {"size": size, "mtime_ns": mtime_ns}
+            header = dict(header, path=path)
+            for column in JSON_COLUMNS:
+                if header.get(column) is not None:
+                    header[column] = json.dumps(header[column])
+            rows.append([header.get(column) for column in INSTANCE_COLUMNS])
+
+        with self.lock:
+            self.conn.executemany("DELETE FROM instances WHERE path = ?", [(path,) for path in removed])
+            placeholders = ", ".join("?" for _ in INSTANCE_COLUMNS)
+            self.conn.executemany(f"INSERT OR REPLACE INTO instances VALUES ({placeholders})", rows)
+            self.conn.commit()
+        return len(changed)
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def series(self):
+        """
+        The series in the directory, largest first
+        """
+        rows = self._query(
+            "SELECT series_uid, study_uid, modality, series_description, COUNT(*) AS num_instances "
+            "FROM instances WHERE series_uid IS NOT NULL "
+            "GROUP BY series_uid ORDER BY num_instances DESC, series_uid"
+        )
+        keys = ["series_uid", "study_uid", "modality", "series_description", "num_instances"]
+        return [DotDict(zip(keys, row)) for row in rows]
+
+    def primary_series_uid(self, modality="CT"):
+        """
+        The series to process in a mixed-series directory: the largest series of the
+        given modality, or the largest series if there is none of that modality.
+        """
+        series = self.series()
+        if not series:
+            raise ValueError(f"no dicom series found in {self.dcm_dir}")
+        candidates = [x for x in series if x.modality == modality] or series
+        if len(series) > 1:
+            print(
+                f"{len(series)} series found in {self.dcm_dir}, using {candidates[0].series_uid} "
+                f"({candidates[0].modality}, {candidates[0].num_instances} instances)"
+            )
+        return candidates[0].series_uid
+
+    def instances(self, series_uid):
+        """
+        Instances of a series ordered along the slice normal
+        """
+        rows = self._query(
+            f"SELECT {', '.join(INSTANCE_COLUMNS)} FROM instances WHERE series_uid = ? "
+            "ORDER BY slice_position, instance_number, path",
+            (series_uid,),
+        )
+        instances = []
+        for row in rows:
+            instance = DotDict(zip(INSTANCE_COLUMNS, row))
+            instance["path"] = os.path.join(self.dcm_dir, instance.path)
+            for column in JSON_COLUMNS:
+                if instance[column] is not None:
+                    instance[column] = tuple(json.loads(instance[column]))
+            instances.append(instance)
+        return instances
+
+    def files(self, series_uid=None):
+        """
+        Paths of the instances of a series in slice order, of all dicom files if series_uid is None
+        """
+        if series_uid is not None:
+            return [instance.path for instance in self.instances(series_uid)]
+        rows = self._query("SELECT path FROM instances WHERE series_uid IS NOT NULL ORDER BY path")
+        return [os.path.join(self.dcm_dir, row[0]) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def get_index_path(dcm_dir, index_dir):
+    """
+    Path of the persisted index of dcm_dir, one per input directory
+    """
+    key = hashlib.sha1(os.path.abspath(dcm_dir).encode("utf-8")).hexdigest()[:16]
+    return get_path(index_dir, f"dicom_index_{key}.sqlite")
+
+
+def get_dicom_index(dcm_dir, index_dir, max_workers=None):
+    """
+    Open the persisted index of dcm_dir in index_dir, building or refreshing it as needed
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    return DicomIndex(dcm_dir, get_index_path(dcm_dir, index_dir), max_workers=max_workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the header index of a dicom directory")
+    parser.add_argument("dcm_dir", help="directory of dicom files")
+    parser.add_argument("index_dir", help="directory to persist the index in")
+    parser.add_argument("--max_workers", type=int, default=None)
+    args = parser.parse_args()
+
+    dicom_index = get_dicom_index(args.dcm_dir, args.index_dir, max_workers=args.max_workers)
+    for series in dicom_index.series():
+        print(f"{series.series_uid} {series.modality} {series.num_instances} instances {series.series_description}")
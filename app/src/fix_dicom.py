@@ -3,9 +3,8 @@ import subprocess
 import shutil
 from pathlib import Path
 from tempfile import TemporaryDirectory
-import pandas as pd
 import re
-from tqdm.auto import tqdm
+from functools import cached_property
 from pprint import pprint
 
 
@@ -30,7 +29,6 @@ class DcmError:
 class DcmBundle:
     def __init__(self, dicom_path: Path):
         self.dicom_path = dicom_path
-        self.ds = pydicom.dcmread(dicom_path)
 
         # find errors
         cmd = ["dciodvfy", "-new", str(dicom_path)]
@@ -38,6 +36,11 @@ class DcmBundle:
         errs = proc.stderr.decode("utf-8").splitlines()
         self.errs = [DcmError(x) for x in errs if x.startswith("Error")]
 
+    @cached_property
+    def ds(self):
+        # the full dataset is only needed for files that have something to fix
+        return pydicom.dcmread(self.dicom_path)
+
     def fix(self):
         for err in self.errs:
             self._fix(err)
@@ -163,17 +166,20 @@ class DcmBundle:
             return errs
 
 
-def fix_dicom_dir(dicom_dir: Path, output_dir: Path):
+def fix_dicom_dir(dicom_dir: Path, output_dir: Path, dcm_files: list = None):
     """Scan the dicom files in dicom_dir and check with dciodvfy for errors. If any errors are found, attempt to fix them and write the fixed dicom files to output_dir.
 
     Args:
         dicom_dir (Path): input directory of dicom files
         output_dir (Path): writes fixed dicom files to this directory if any fixes are required
+        dcm_files (list, optional): dicom files to check, e.g. one series from a DicomIndex. Defaults to all dicom files in dicom_dir
 
     Returns:
         _type_: output_dir if any fixes were required, otherwise dicom_dir
     """
-    dcm_files = [x for x in dicom_dir.rglob("*") if pydicom.misc.is_dicom(x)]
+    if dcm_files is None:
+        dcm_files = [x for x in dicom_dir.rglob("*") if pydicom.misc.is_dicom(x)]
+    dcm_files = [Path(x) for x in dcm_files]
 
     dss = [DcmBundle(dcm_file) for dcm_file in dcm_files]
 
@@ -193,6 +199,10 @@ def fix_dicom_dir(dicom_dir: Path, output_dir: Path):
 
 
 def fix_it_all():
+    # only needed for this batch job, keep them off the import path of the pipeline
+    import pandas as pd
+    from tqdm.auto import tqdm
+
     logged_errors = set()
     df = pd.read_csv("/home/vanossj/projects/aimi-idc-data/tasks/non-complient-dcm.csv")
     for i, row in tqdm(df.iterrows(), total=len(df)):
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import multiprocessing as mp
+import os
+import queue
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import resource_tracker, shared_memory
+from timeit import default_timer as timer
+import numpy as np
+import torch
+from bamf_nnunet_inference import BAMFnnUNetModelCache, preprocess_for_task
+from io_utils import DotDict
+
+
+# per worker process state, set up by _init_worker
+_worker_models = None
+
+
+def _init_worker(threads_per_worker, core_sets):
+    """
+    Give the worker its intra-op thread budget and, when available, a dedicated set of cores.
+    """
+    global _worker_models
+    _worker_models = BAMFnnUNetModelCache(max_models=1)
+    torch.set_num_threads(threads_per_worker)
+    torch.set_num_interop_threads(1)
+    if core_sets is None:
+        print(f"worker {os.getpid()}: {threads_per_worker} threads, not pinned")
+        return
+    try:
+        # one set was queued per worker, the wait only covers the queue's feeder thread
+        cores = core_sets.get(timeout=5)
+    except queue.Empty:
+        print(f"worker {os.getpid()}: {threads_per_worker} threads, no core set left, not pinned")
+        return
+    os.sched_setaffinity(0, cores)
+    print(f"worker {os.getpid()}: {threads_per_worker} threads pinned to cores {sorted(cores)}")
+
+
+def _attach_shared_input(shared_input):
+    shm = shared_memory.SharedMemory(name=shared_input["shm_name"])
+    # the parent owns the segment, keep the worker's resource tracker from unlinking it
+    resource_tracker.unregister(shm._name, "shared_memory")
+    data = np.ndarray(shared_input["shape"], dtype=shared_input["dtype"], buffer=shm.buf)
+    return shm, data
+
+
+def _infer_unit(unit, shared_input):
+    """
+    Infer a single (task, fold) unit on the preprocessed CT held in shared memory.
+    """
+    start = timer()
+    context = DotDict({
+        "checkpoint_path": unit["checkpoint_path"],
+        "input_file": unit["input_file"],
+        "pt_file": None,
+        "prediction_save": unit["prediction_save"],
+        "predict_aug": False,
+        "softmax": False,
+        "organ_name": unit["organ_name"],
+        "fold": unit["fold"],
+        "output_ext": unit.get("output_ext"),
+        "network_space": unit.get("network_space", False),
+        "quantized": unit.get("quantized", False),
+        "max_dice_drop": unit.get("max_dice_drop"),
+        "accumulator_dtype": unit.get("accumulator_dtype"),
+        "spill_dir": unit.get("spill_dir"),
+        "use_bundle": unit.get("use_bundle", True),
+    })
+    shm, data = _attach_shared_input(shared_input)
+    try:
+        with _worker_models.acquire(context.checkpoint_path, context.fold) as model:
+            model.initialize(context)
+            model.properties = shared_input["properties"]
+            inferred = model.inference(data)
+            model.postprocess(inferred)
+    finally:
+        del data
+        shm.close()
+    return unit, timer() - start
+
+
+def get_core_sets(num_workers, threads_per_worker):
+    """
+    Split the cores available to this process into disjoint sets, one per worker.
+    Returns None when there are not enough cores to pin every worker.
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < num_workers * threads_per_worker:
+        return None
+    return [set(cores[i * threads_per_worker:(i + 1) * threads_per_worker]) for i in range(num_workers)]
+
+
+class FoldScheduler:
+    """
+    Distributes (task, fold) inference units across a pool of worker processes.
+    The CT is preprocessed once per task and shared with the workers through shared memory.
+
+    Args:
+        num_workers (int): number of worker processes
+        threads_per_worker (int): torch intra-op threads of each worker
+    """
+
+    def __init__(self, num_workers, threads_per_worker):
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+
+    def run(self, units, on_inference_start=None):
+        """
+        Infer all units, yielding (unit, seconds) as each one completes so the caller
+        can feed the fold predictions into the ensemble right away.
+
+        Args:
+            units (list): dicts with checkpoint_path, fold, input_file, prediction_save and organ_name
+            on_inference_start (callable, optional): called once the preprocessed CT is shared
+                and the units are handed to the workers
+        """
+        if not units:
+            return
+        # spawn so CUDA and the torch thread pools are set up fresh in each worker
+        mp_context = mp.get_context("spawn")
+        core_sets = None
+        available_core_sets = get_core_sets(self.num_workers, self.threads_per_worker)
+        if available_core_sets is None:
+            print(
+                f"not pinning workers: {self.num_workers} workers x {self.threads_per_worker} threads "
+                "need more cores than are available, or core affinity is unsupported"
+            )
+        else:
+            core_sets = mp_context.Queue()
+            for cores in available_core_sets:
+                core_sets.put(cores)
+
+        shared_inputs = {}
+        segments = []
+        try:
+            for checkpoint_path, input_file in sorted({(u["checkpoint_path"], u["input_file"]) for u in units}):
+                data, properties = preprocess_for_task(checkpoint_path, input_file)
+                data = np.ascontiguousarray(data)
+                shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+                segments.append(shm)
+                np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[:] = data
+                shared_inputs[checkpoint_path] = {
+                    "shm_name": shm.name,
+                    "shape": data.shape,
+                    "dtype": data.dtype.str,
+                    "properties": properties,
+                }
+                del data
+
+            with ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=mp_context,
+                initializer=_init_worker,
+                initargs=(self.threads_per_worker, core_sets),
+            ) as executor:
+                futures = [
+                    executor.submit(_infer_unit, unit, shared_inputs[unit["checkpoint_path"]])
+                    for unit in units
+                ]
+                if on_inference_start is not None:
+                    on_inference_start()
+                for future in as_completed(futures):
+                    yield future.result()
+        finally:
+            for shm in segments:
+                shm.close()
+                shm.unlink()
+
+
+def benchmark(units, worker_counts, threads_per_worker_counts, output_csv=None):
+    """
+    Time the scheduler over a grid of worker counts and thread budgets and print the
+    scaling curve relative to the first configuration.
+    """
+    rows = []
+    for num_workers in worker_counts:
+        for threads_per_worker in threads_per_worker_counts:
+            with tempfile.TemporaryDirectory() as prediction_save:
+                bench_units = [dict(u, prediction_save=prediction_save) for u in units]
+                start = timer()
+                unit_times = [t for _, t in FoldScheduler(num_workers, threads_per_worker).run(bench_units)]
+                wall = timer() - start
+            rows.append({
+                "num_workers": num_workers,
+                "threads_per_worker": threads_per_worker,
+                "total_threads": num_workers * threads_per_worker,
+                "wall_seconds": round(wall, 2),
+                "mean_unit_seconds": round(float(np.mean(unit_times)), 2),
+            })
+            print(rows[-1])
+    baseline = rows[0]["wall_seconds"]
+    print(f"{'workers':>8} {'threads':>8} {'total':>6} {'wall_s':>8} {'speedup':>8}")
+    for row in rows:
+        row["speedup"] = round(baseline / row["wall_seconds"], 2)
+        print(
+            f"{row['num_workers']:>8} {row['threads_per_worker']:>8} {row['total_threads']:>6} "
+            f"{row['wall_seconds']:>8} {row['speedup']:>8}"
+        )
+    if output_csv:
+        with open(output_csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
+
+
+if __name__ == "__main__":
+    from run import get_model_paths
+
+    parser = argparse.ArgumentParser(description="Benchmark the multi-core fold scheduler")
+    parser.add_argument("input_file", help="path to input CT nii file")
+    parser.add_argument("--num_folds", type=int, default=5)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--threads_per_worker", type=int, nargs="+", default=[4, 8, 16])
+    parser.add_argument("--output_csv", help="write the scaling curve to this csv file")
+    args = parser.parse_args()
+
+    model_path_nodules, model_path_nsclc_rg = get_model_paths()
+    units = []
+    for organ_name_prefix, checkpoint_path in [
+        ("ct_nodules_fold", model_path_nodules),
+        ("ct_nsclc_rg_fold", model_path_nsclc_rg),
+    ]:
+        for fold_idx in range(args.num_folds):
+            units.append({
+                "checkpoint_path": checkpoint_path,
+                "fold": fold_idx,
+                "input_file": os.path.abspath(args.input_file),
+                "organ_name": f"{organ_name_prefix}_{fold_idx}",
+            })
+    benchmark(units, args.workers, args.threads_per_worker, args.output_csv)
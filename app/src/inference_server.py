@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+import argparse
+import copy
+import json
+import os
+import shutil
+import signal
+import socket
+import socketserver
+import tempfile
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from timeit import default_timer as timer
+from io_utils import StageTimer
+from run import get_model_paths, get_runner_args, load_config, run_nnunet, validate_config
+
+# torch and nnunet are imported when the server starts, not at module level: the spawned
+# header readers of the dicom index re-import this module
+
+# options a job is allowed to override on top of the NNUnetRunner config
+JOB_OPTIONS = ["output_nodules_seg_name", "output_lesions_seg_name", "organ_label"]
+
+
+class InferenceServer:
+    """
+    Long running server that keeps every fold model resident and accepts segmentation
+    jobs over a Unix domain socket. Each request is a single line of JSON:
+
+        {"action": "submit", "source_ct_dir": ..., "target_dir": ..., "options": {...}}
+        {"action": "status", "job_id": ...}
+        {"action": "drain"}
+
+    Args:
+        config (dict): loaded default.yml, used for the NNUnetRunner defaults
+        socket_path (str): path of the Unix domain socket to listen on
+        max_jobs (int): number of jobs allowed to run concurrently, the rest are queued
+        work_dir (str): root under which each job gets its own scratch dir
+        max_finished_jobs (int): finished jobs kept for status queries, the oldest are evicted
+    """
+
+    def __init__(self, config, socket_path, max_jobs=1, work_dir="/tmp/aimi-jobs", max_finished_jobs=1000):
+        from bamf_nnunet_inference import BAMFnnUNetModelCache
+
+        self.config = config
+        self.runner_args = get_runner_args(config)
+        if self.runner_args["num_workers"] > 0:
+            # fold workers load their own models, the resident ones would never be used
+            raise ValueError("NNUnetRunner.num_workers must be 0 in server mode")
+        self.socket_path = socket_path
+        self.max_jobs = max_jobs
+        self.work_dir = work_dir
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = {}
+        self.stage_timers = {}
+        self.jobs_lock = threading.Lock()
+        self.draining = threading.Event()
+        self.model_cache = BAMFnnUNetModelCache()
+        self.executor = ThreadPoolExecutor(max_workers=max_jobs)
+
+    def warm_up(self):
+        """
+        Load the fold models of both tasks before accepting any job.
+        """
+        print("loading fold models..")
+        self.model_cache.preload(
+            get_model_paths(),
+            self.runner_args["num_folds"],
+            use_bundle=self.runner_args["use_model_bundles"],
+            quantized=self.runner_args["precision"] == "int8",
+            max_dice_drop=self.runner_args["int8_max_dice_drop"],
+        )
+        print(f"{len(self.model_cache.models)} fold models resident")
+
+    def submit(self, request):
+        if self.draining.is_set():
+            return {"error": "server is draining, not accepting new jobs"}
+        source_ct_dir = request.get("source_ct_dir")
+        target_dir = request.get("target_dir")
+        if not source_ct_dir or not target_dir:
+            return {"error": "source_ct_dir and target_dir are required"}
+        options = request.get("options", {})
+        if not isinstance(options, dict):
+            return {"error": "options must be an object"}
+        unknown = set(options) - set(JOB_OPTIONS)
+        if unknown:
+            return {"error": f"unsupported options: {sorted(unknown)}"}
+
+        # the job options go through the same checks and conversions as the config of a CLI run
+        config = copy.deepcopy(self.config)
+        config["modules"]["NNUnetRunner"].update(options, source_ct_dir=source_ct_dir, target_dir=target_dir)
+        try:
+            validate_config(config)
+        except ValueError as e:
+            return {"error": str(e)}
+        runner_args = get_runner_args(config)
+
+        job_id = uuid.uuid4().hex
+        job = {"job_id": job_id, "status": "queued", "timings": {}, "error": None}
+        with self.jobs_lock:
+            self.jobs[job_id] = job
+        self.executor.submit(self._run_job, job, runner_args)
+        return {"job_id": job_id, "status": job["status"]}
+
+    def _evict_finished_jobs(self):
+        with self.jobs_lock:
+            finished = [job_id for job_id, job in self.jobs.items() if job["status"] in ("done", "failed")]
+            # jobs are kept in submission order, the oldest finished ones go first
+            for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+                del self.jobs[job_id]
+
+    def _run_job(self, job, runner_args):
+        job["status"] = "running"
+        # time_to_first_voxel of a job counts from when it starts, not from server start
+        start_time = timer()
+        stage_timer = StageTimer()
+        # live view of the timings while the job is running
+        with self.jobs_lock:
+            self.stage_timers[job["job_id"]] = stage_timer
+        Path(self.work_dir).mkdir(parents=True, exist_ok=True)
+        job_work_dir = tempfile.mkdtemp(prefix=f"{job['job_id']}-", dir=self.work_dir)
+        try:
+            run_nnunet(
+                **runner_args,
+                work_dir=job_work_dir,
+                model_cache=self.model_cache,
+                stage_timer=stage_timer,
+                start_time=start_time,
+            )
+            job["status"] = "done"
+        except Exception as e:
+            traceback.print_exc()
+            job["status"] = "failed"
+            job["error"] = repr(e)
+        finally:
+            job["timings"] = stage_timer.snapshot()
+            with self.jobs_lock:
+                del self.stage_timers[job["job_id"]]
+            shutil.rmtree(job_work_dir, ignore_errors=True)
+            self._evict_finished_jobs()
+
+    def status(self, request):
+        with self.jobs_lock:
+            job = self.jobs.get(request.get("job_id"))
+            stage_timer = self.stage_timers.get(request.get("job_id"))
+        if job is None:
+            return {"error": f"unknown job_id: {request.get('job_id')}"}
+        if stage_timer is not None:
+            return dict(job, timings=stage_timer.snapshot())
+        return dict(job)
+
+    def handle_request(self, request):
+        action = request.get("action")
+        if action == "submit":
+            return self.submit(request)
+        elif action == "status":
+            return self.status(request)
+        elif action == "drain":
+            self.draining.set()
+            return {"status": "draining"}
+        return {"error": f"unknown action: {action}"}
+
+    def serve(self):
+        server_ref = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline()
+                try:
+                    response = server_ref.handle_request(json.loads(line))
+                except json.JSONDecodeError as e:
+                    response = {"error": f"invalid request: {e}"}
+                except Exception as e:
+                    traceback.print_exc()
+                    response = {"error": f"failed to handle request: {e!r}"}
+                self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = socketserver.ThreadingUnixStreamServer(self.socket_path, RequestHandler)
+        server.daemon_threads = True
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+
+        # SIGTERM / SIGINT stop accepting jobs, running and queued jobs are allowed to finish
+        signal.signal(signal.SIGTERM, lambda *_: self.draining.set())
+        signal.signal(signal.SIGINT, lambda *_: self.draining.set())
+        print(f"listening on {self.socket_path} with {self.max_jobs} concurrent job(s)")
+        self.draining.wait()
+
+        print("draining, waiting for running jobs to finish..")
+        self.executor.shutdown(wait=True)
+        server.shutdown()
+        server.server_close()
+        os.remove(self.socket_path)
+        print("drained")
+
+
+def send_request(socket_path, request):
+    """
+    Send a single JSON request to a running InferenceServer and return its response
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        response = sock.makefile("r").readline()
+    return json.loads(response)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warm nnUNet inference server")
+    parser.add_argument("--config", default="default.yml", help="Path to the YAML configuration file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("serve", help="start the server")
+    submit_parser = subparsers.add_parser("submit", help="submit a job")
+    submit_parser.add_argument("source_ct_dir", help="dir containing list of dcm files")
+    submit_parser.add_argument("target_dir", help="dir to write segmented dcm masks too")
+    status_parser = subparsers.add_parser("status", help="query a job")
+    status_parser.add_argument("job_id")
+    subparsers.add_parser("drain", help="stop accepting jobs and exit once running jobs finish")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    server_config = config.get("modules", {}).get("InferenceServer", {})
+    socket_path = server_config.get("socket_path")
+
+    if args.command == "serve":
+        inference_server = InferenceServer(
+            config=config,
+            socket_path=socket_path,
+            max_jobs=int(server_config.get("max_jobs")),
+            work_dir=server_config.get("work_dir"),
+            max_finished_jobs=int(server_config.get("max_finished_jobs", 1000)),
+        )
+        inference_server.warm_up()
+        inference_server.serve()
+    elif args.command == "submit":
+        print(send_request(socket_path, {
+            "action": "submit",
+            "source_ct_dir": os.path.abspath(args.source_ct_dir),
+            "target_dir": os.path.abspath(args.target_dir),
+        }))
+    elif args.command == "status":
+        print(send_request(socket_path, {"action": "status", "job_id": args.job_id}))
+    elif args.command == "drain":
+        print(send_request(socket_path, {"action": "drain"}))
@@ -0,0 +1,113 @@
+import json
+import os
+import numpy as np
+from io_utils import DotDict
+
+
+# NIfTI-1 datatype codes understood by open_nifti_memmap
+NIFTI_DTYPES = {
+    2: np.uint8,
+    4: np.int16,
+    8: np.int32,
+    16: np.float32,
+    64: np.float64,
+    256: np.int8,
+    512: np.uint16,
+    768: np.uint32,
+    1024: np.int64,
+    1280: np.uint64,
+}
+
+
+def strip_nifti_ext(path):
+    path = str(path)
+    for ext in [".nii.gz", ".nii", ".npy"]:
+        if path.endswith(ext):
+            return path[: -len(ext)]
+    return path
+
+
+def get_sidecar_path(path):
+    """
+    Path of the JSON geometry sidecar of an intermediate volume, e.g. ct_0000.nii -> ct_0000.json
+    """
+    return strip_nifti_ext(path) + ".json"
+
+
+def get_export_info_path(path):
+    """
+    Path of the pickle with the nnUNet properties needed to bring a network grid
+    prediction back to the CT, e.g. ct_nodules_fold_0.npy -> ct_nodules_fold_0.pkl
+    """
+    return strip_nifti_ext(path) + ".pkl"
+
+
+def write_geometry_sidecar(path, geometry):
+    """
+    Write spacing, origin and direction of a volume next to it
+    """
+    sidecar_path = get_sidecar_path(path)
+    tmp_path = sidecar_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({k: list(geometry[k]) for k in ["spacing", "origin", "direction"]}, f)
+    os.replace(tmp_path, sidecar_path)
+
+
+def read_geometry_sidecar(path):
+    """
+    Read the geometry sidecar of a volume, None if there is none
+    """
+    sidecar_path = get_sidecar_path(path)
+    if not os.path.isfile(sidecar_path):
+        return None
+    with open(sidecar_path, "r") as f:
+        geometry = json.load(f)
+    return DotDict({k: tuple(v) for k, v in geometry.items()})
+
+
+def open_nifti_memmap(path):
+    """
+    Memory-map the voxels of an uncompressed NIfTI-1 file. Returns a read-only (z, y, x) array,
+    same layout as sitk.GetArrayFromImage, whose pages are only read when touched.
+    Returns None when the file can't be mapped as is (e.g. scaled intensities).
+    """
+    with open(path, "rb") as f:
+        header = f.read(348)
+    if len(header) < 348:
+        return None
+    for endian in ["<", ">"]:
+        if np.frombuffer(header, dtype=f"{endian}i4", count=1, offset=0)[0] == 348:
+            break
+    else:
+        return None
+    dims = np.frombuffer(header, dtype=f"{endian}i2", count=8, offset=40)
+    datatype = int(np.frombuffer(header, dtype=f"{endian}i2", count=1, offset=70)[0])
+    vox_offset = float(np.frombuffer(header, dtype=f"{endian}f4", count=1, offset=108)[0])
+    scl_slope = float(np.frombuffer(header, dtype=f"{endian}f4", count=1, offset=112)[0])
+    scl_inter = float(np.frombuffer(header, dtype=f"{endian}f4", count=1, offset=116)[0])
+    if datatype not in NIFTI_DTYPES or scl_slope not in (0.0, 1.0) or scl_inter != 0.0:
+        return None
+    ndim = int(dims[0])
+    shape = tuple(int(d) for d in dims[1:ndim + 1][::-1])
+    # trailing singleton dimensions, e.g. a 3D volume stored with t=1
+    while len(shape) > 3 and shape[0] == 1:
+        shape = shape[1:]
+    dtype = np.dtype(NIFTI_DTYPES[datatype]).newbyteorder(endian)
+    return np.memmap(path, dtype=dtype, mode="r", offset=int(vox_offset), shape=shape)
+
+
+def open_volume(path):
+    """
+    Open an intermediate volume as a (z, y, x) array. Raw .npy and uncompressed .nii
+    files are memory-mapped, anything else is decoded with SimpleITK.
+    """
+    path = str(path)
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+    if path.endswith(".nii"):
+        data = open_nifti_memmap(path)
+        if data is not None:
+            return data
+    import SimpleITK as sitk
+
+    return sitk.GetArrayFromImage(sitk.ReadImage(path))
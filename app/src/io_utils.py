@@ -2,8 +2,10 @@
 import argparse
 import shutil
 import sys
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-import pydicom
+from timeit import default_timer as timer
 import os
 
 
@@ -25,19 +27,76 @@ def get_path(*paths):
     return os.path.join(*paths)
 
 
-def copy_to_series_dir(input_file, dcm_dir, output_dir):
-    series_uid = None
+class StageTimer:
+    """
+    Accumulates wall-clock time spent in named pipeline stages.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = timer()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.timings[name] = self.timings.get(name, 0.0) + timer() - start
+
+    def mark_once(self, name, since):
+        """
+        Record the time elapsed since a reference point the first time an event happens,
+        e.g. the time to first voxel.
+        """
+        with self.lock:
+            if name not in self.timings:
+                self.timings[name] = timer() - since
+                print(f"{name}: {self.timings[name]:.2f}s")
+
+    def snapshot(self):
+        """Copy of the timings, safe to take while stages are still running"""
+        with self.lock:
+            return dict(self.timings)
+
+
+@contextmanager
+def atomic_output(path):
+    """
+    Yield a temporary path next to path and move it into place only once the block
+    succeeds, so a crash never leaves a half-written file behind under the final name.
+    The temporary name keeps the extension, so writers that pick the format from it still work.
+    """
+    out_dir, name = os.path.split(str(path))
+    tmp_path = os.path.join(out_dir, f".partial-{name}")
     try:
-        for f in dcm_dir.glob("*"):
-            ds = pydicom.dcmread(f, stop_before_pixels=True)
-            series_uid = ds.SeriesInstanceUID
-            break
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_lesion_table_path(seg_path, ext):
+    """
+    Path of the lesion table written next to a mask, e.g. seg_nodules_ensemble.nii.gz -> seg_nodules_ensemble_lesions.json
+    """
+    seg_dir, seg_name = os.path.split(seg_path)
+    return get_path(seg_dir, seg_name.split('.')[0].strip() + f"_lesions.{ext}")
+
+
+def copy_to_series_dir(input_file, dcm_dir, output_dir, dicom_index=None):
+    from dicom_index import DicomIndex
+
+    try:
+        if dicom_index is None:
+            dicom_index = DicomIndex(dcm_dir)
+        series_uid = dicom_index.primary_series_uid()
     except:
         print("Failed to read dicom files")
         sys.exit(1)
 
-    assert series_uid is not None
-
     output_path = output_dir / series_uid / input_file.name
     output_path.parent.mkdir(parents=True, exist_ok=True)
     shutil.copy(input_file, output_path)
@@ -48,10 +107,18 @@ if __name__ == "__main__":
     parser.add_argument("input_file", type=Path)
     parser.add_argument("dcm_dir", type=Path)
     parser.add_argument("output_dir", type=Path)
+    parser.add_argument("--index_dir", type=Path, default=None, help="reuse the dicom index persisted in this dir")
     args = parser.parse_args()
 
+    dicom_index = None
+    if args.index_dir is not None:
+        from dicom_index import get_dicom_index
+
+        dicom_index = get_dicom_index(args.dcm_dir, args.index_dir)
+
     copy_to_series_dir(
         input_file=args.input_file,
         dcm_dir=args.dcm_dir,
-        output_dir=args.output_dir
+        output_dir=args.output_dir,
+        dicom_index=dicom_index,
     )
@@ -1,41 +1,131 @@
+import csv
+import json
 import os
+import tempfile
 import SimpleITK as sitk
 import numpy as np
+from scipy import ndimage
+from scipy.spatial.distance import pdist
 from skimage import measure
-from io_utils import get_path
+from intermediate_store import open_volume, read_geometry_sidecar
+from io_utils import DotDict, atomic_output, get_lesion_table_path, get_path
 
 
-class LungPostProcessor:
-    def __init__(self):
-        pass
+LESION_TABLE_FIELDS = [
+    "lesion_id",
+    "voxel_count",
+    "volume_mm3",
+    "bbox_min_x", "bbox_min_y", "bbox_min_z",
+    "bbox_max_x", "bbox_max_y", "bbox_max_z",
+    "centroid_x_mm", "centroid_y_mm", "centroid_z_mm",
+    "longest_axial_diameter_mm",
+    "lung_side",
+]
+
+
+class FoldVotes:
+    """
+    Running per-voxel vote counts over the fold predictions of both tasks. Folds can be
+    added in any order, e.g. as they come back from the fold scheduler, so the ensemble
+    is ready as soon as the last fold finishes.
+
+    Args:
+        lung_label (int): label of lung assigned in AIMI dataset
+        slab_size (int, optional): axial slices thresholded at a time by ensemble, the whole
+            volume by default
+        spill_dir (str, optional): keep the vote counts in memory-mapped files in this dir
+            instead of in memory
+    """
+
+    def __init__(self, lung_label, slab_size=None, spill_dir=None):
+        self.lung_label = lung_label
+        self.slab_size = slab_size
+        self.spill_dir = spill_dir
+        self.votes = {}
+
+    def _zeros(self, shape):
+        if self.spill_dir is None:
+            return np.zeros(shape, dtype=np.uint8)
+        # an anonymous file, removed as soon as the memmap is released
+        return np.memmap(tempfile.TemporaryFile(dir=self.spill_dir), dtype=np.uint8, mode="w+", shape=shape)
 
-    def get_ensemble(self, save_path, organ_name_prefix, label, num_folds=5, th=0.6):
+    def _add(self, name, mask, shape, roi):
+        if name not in self.votes:
+            self.votes[name] = self._zeros(shape)
+        if roi is None:
+            self.votes[name] += mask
+        else:
+            self.votes[name][roi] += mask
+
+    def add_nodules_fold(self, seg_data, roi=None):
+        """Add one fold prediction of Task777_CT_Nodules, optionally only inside roi"""
+        seg_roi = seg_data if roi is None else seg_data[roi]
+        self._add("nodules", seg_roi == self.lung_label, seg_data.shape, roi)
+
+    def add_nsclc_rg_fold(self, seg_data, roi=None):
+        """Add one fold prediction of Task775_CT_NSCLC_RG, optionally only inside roi"""
+        seg_roi = seg_data if roi is None else seg_data[roi]
+        self._add("lesions", seg_roi == self.lung_label, seg_data.shape, roi)
+        self._add("lungs", seg_roi > 0, seg_data.shape, roi)
+
+    def add_fold_file(self, inp_seg_path, is_nodules, roi=None):
+        """
+        Add a fold prediction file. Uncompressed intermediates are memory-mapped, so with a
+        roi only the pages covering it are read.
         """
-        Perform ensemble segmentation on medical image data.
+        seg_data = open_volume(inp_seg_path)
+        if is_nodules:
+            self.add_nodules_fold(seg_data, roi=roi)
+        else:
+            self.add_nsclc_rg_fold(seg_data, roi=roi)
+
+    def ensemble(self, name, num_folds=5, th=0.6):
+        """
+        Threshold the fraction of folds voting for a voxel.
 
         Args:
-            save_path (str): Path to the directory where segmentation results will be saved.
-            organ_name_prefix (str): A prefix to construct and fetch segmented paths that nnUNet creates
-            label (int): Label value for the segmentation.
+            name (str): one of "nodules", "lesions" or "lungs"
             num_folds (int, optional): Number of folds for ensemble. Default is 5.
             th (float, optional): Threshold value. Default is 0.6.
 
         Returns:
             np.ndarray: Segmentation results.
         """
-        for fold in range(num_folds):
-            inp_seg_file = f"{organ_name_prefix}_{fold}.nii.gz"
-            inp_seg_path = get_path(save_path, inp_seg_file)
-            seg_data = sitk.GetArrayFromImage(sitk.ReadImage(inp_seg_path))
-            seg_data[seg_data != label] = 0
-            seg_data[seg_data == label] = 1
-            if fold == 0:
-                segs = np.zeros(seg_data.shape)
-            segs += seg_data
-        segs = segs / 5
-        segs[segs < th] = 0
-        segs[segs >= th] = 1
-        return segs
+        votes = self.votes[name]
+        slab_size = self.slab_size or len(votes)
+        mask = np.empty(votes.shape, dtype=np.uint8)
+        for start in range(0, len(votes), slab_size):
+            mask[start:start + slab_size] = votes[start:start + slab_size] / num_folds >= th
+        return mask
+
+    def label_map(self, name, num_folds=5, th=0.6, with_lungs=False):
+        """
+        Encode the ensemble of name, and optionally the lungs, as one label map: 0 background,
+        1 lungs, 2 name. Voxels of name outside the lungs are dropped, as postprocessing would.
+        Lets the ensembles of a task be resampled to the CT in one pass.
+
+        Args:
+            name (str): "nodules" or "lesions"
+            num_folds (int, optional): Number of folds for ensemble. Default is 5.
+            th (float, optional): Threshold value. Default is 0.6.
+            with_lungs (bool, optional): add the lungs, which have to be on the same grid as name
+
+        Returns:
+            np.ndarray: uint8 label map.
+        """
+        mask = self.ensemble(name, num_folds=num_folds, th=th)
+        label_map = np.zeros(mask.shape, dtype=np.uint8)
+        if with_lungs:
+            lungs = self.ensemble("lungs", num_folds=num_folds, th=th)
+            label_map[lungs == 1] = 1
+            mask[lungs == 0] = 0
+        label_map[mask == 1] = 2
+        return label_map
+
+
+class LungPostProcessor:
+    def __init__(self):
+        pass
 
     def n_connected(self, img_data):
         """
@@ -47,7 +137,7 @@ class LungPostProcessor:
         Returns:
             np.ndarray: Processed image with the largest connected component.
         """
-        img_filtered = np.zeros(img_data.shape)
+        img_filtered = np.zeros(img_data.shape, dtype=np.uint8)
         blobs_labels = measure.label(img_data, background=0)
         lbl, counts = np.unique(blobs_labels, return_counts=True)
         lbl_dict = {}
@@ -65,27 +155,127 @@ class LungPostProcessor:
         img_data[img_filtered != 1] = 0
         return img_data
     
-    def get_lungs(self, save_path, lesion_prefix, th=0.6):
-        for fold_idx in range(5):
-            nnunet_seg_file_fold = f"{lesion_prefix}_{fold_idx}.nii.gz"
-            ip_path = get_path(save_path, nnunet_seg_file_fold)
-            seg_data = sitk.GetArrayFromImage(sitk.ReadImage(ip_path))
-            seg_data[seg_data > 0] = 1
-            if fold_idx == 0:
-                segs = np.zeros(seg_data.shape)
-            segs += seg_data
-        segs = segs / 5
-        segs[segs < th] = 0
-        segs[segs >= th] = 1
-        return segs
-
-    def get_seg_img(self, lungs, nodules, ct_path):
-        seg_data = np.zeros(lungs.shape)
+    def get_ct_geometry(self, ct_path):
+        """
+        Read spacing, origin and direction of the CT from its geometry sidecar, or from its
+        header, without loading any voxels.
+        """
+        geometry = read_geometry_sidecar(ct_path)
+        if geometry is not None:
+            return geometry
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(str(ct_path))
+        reader.ReadImageInformation()
+        return DotDict({
+            "spacing": reader.GetSpacing(),
+            "origin": reader.GetOrigin(),
+            "direction": reader.GetDirection(),
+        })
+
+    def _index_to_physical(self, index_zyx, geometry):
+        index_xyz = np.asarray(index_zyx, dtype=np.float64)[::-1]
+        direction = np.asarray(geometry.direction, dtype=np.float64).reshape(3, 3)
+        return np.asarray(geometry.origin) + direction @ (index_xyz * np.asarray(geometry.spacing))
+
+    def _longest_axial_diameter(self, component, spacing):
+        """
+        Largest in-plane distance between two boundary voxels over all axial slices of a component.
+        """
+        longest = 0.0
+        for axial_slice in component:
+            if not axial_slice.any():
+                continue
+            boundary = axial_slice & ~ndimage.binary_erosion(axial_slice)
+            points = np.argwhere(boundary) * np.asarray([spacing[1], spacing[0]])
+            if len(points) > 1:
+                longest = max(longest, float(pdist(points).max()))
+        return longest
+
+    def measure_lesions(self, mask, lungs, geometry):
+        """
+        Measure every connected component of a mask in a single labeling pass.
+
+        Args:
+            mask (np.ndarray): binary nodule or lesion mask (z, y, x).
+            lungs (np.ndarray): binary lung mask, used to assign a lung side.
+            geometry (DotDict): spacing, origin and direction of the CT.
+
+        Returns:
+            list: one dict per component with the fields of LESION_TABLE_FIELDS.
+        """
+        labels, num_lesions = ndimage.label(mask > 0, structure=np.ones((3, 3, 3)))
+        if num_lesions == 0:
+            return []
+        voxel_counts = np.bincount(labels.ravel(), minlength=num_lesions + 1)
+        voxel_volume = float(np.prod(geometry.spacing))
+        # patients left is +x in LPS, so compare each lesion against the lung midline
+        midline_x = self._index_to_physical(ndimage.center_of_mass(lungs > 0), geometry)[0] if lungs.any() else None
+
+        lesions = []
+        for lesion_id, bbox in enumerate(ndimage.find_objects(labels), start=1):
+            component = labels[bbox] == lesion_id
+            offset = np.array([s.start for s in bbox])
+            centroid = self._index_to_physical(np.argwhere(component).mean(axis=0) + offset, geometry)
+            if midline_x is None:
+                lung_side = ""
+            else:
+                lung_side = "left" if centroid[0] > midline_x else "right"
+            lesions.append({
+                "lesion_id": lesion_id,
+                "voxel_count": int(voxel_counts[lesion_id]),
+                "volume_mm3": round(float(voxel_counts[lesion_id]) * voxel_volume, 3),
+                "bbox_min_x": bbox[2].start, "bbox_min_y": bbox[1].start, "bbox_min_z": bbox[0].start,
+                "bbox_max_x": bbox[2].stop - 1, "bbox_max_y": bbox[1].stop - 1, "bbox_max_z": bbox[0].stop - 1,
+                "centroid_x_mm": round(float(centroid[0]), 3),
+                "centroid_y_mm": round(float(centroid[1]), 3),
+                "centroid_z_mm": round(float(centroid[2]), 3),
+                "longest_axial_diameter_mm": round(self._longest_axial_diameter(component, geometry.spacing), 3),
+                "lung_side": lung_side,
+            })
+        return lesions
+
+    def write_lesion_table(self, lesions, seg_path):
+        """
+        Write the lesion table as json and csv next to the mask at seg_path.
+        """
+        with atomic_output(get_lesion_table_path(seg_path, "json")) as tmp_path:
+            with open(tmp_path, "w") as f:
+                json.dump(lesions, f, indent=2)
+        with atomic_output(get_lesion_table_path(seg_path, "csv")) as tmp_path:
+            with open(tmp_path, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=LESION_TABLE_FIELDS)
+                writer.writeheader()
+                writer.writerows(lesions)
+
+    def get_roi(self, mask):
+        """
+        Bounding box of a mask as a tuple of slices, None if the mask is empty.
+        """
+        objects = ndimage.find_objects((mask > 0).astype(np.uint8))
+        return objects[0] if objects else None
+
+    def get_seg_img(self, lungs, nodules, ct_path=None, geometry=None):
+        """
+        Combine lungs (1) and nodules (2) into a uint8 label image on the CT grid.
+
+        Args:
+            lungs (np.ndarray): binary lung mask.
+            nodules (np.ndarray): binary nodule or lesion mask.
+            ct_path (str, optional): CT to take the geometry from when geometry is not given.
+            geometry (DotDict, optional): spacing, origin and direction of the CT.
+
+        Returns:
+            sitk.Image: label image.
+        """
+        seg_data = np.zeros(lungs.shape, dtype=np.uint8)
         seg_data[lungs == 1] = 1
         seg_data[nodules == 1] = 2
-        ref = sitk.ReadImage(ct_path)
+        if geometry is None:
+            geometry = self.get_ct_geometry(ct_path)
         seg_img = sitk.GetImageFromArray(seg_data)
-        seg_img.CopyInformation(ref)
+        seg_img.SetSpacing(geometry.spacing)
+        seg_img.SetOrigin(geometry.origin)
+        seg_img.SetDirection(geometry.direction)
         return seg_img
     
     def postprocessing(
@@ -95,8 +285,15 @@ class LungPostProcessor:
             output_nodules_seg_path: str,
             output_lesions_seg_path: str,            
             organ_name_nodules_prefix: str,
-            organ_name_nsclc_rg_prefix: str,            
-            lung_label: int
+            organ_name_nsclc_rg_prefix: str,
+            lung_label: int,
+            num_folds: int = 5,
+            fold_votes: FoldVotes = None,
+            ct_geometry: DotDict = None,
+            fold_ext: str = ".nii.gz",
+            network_ensemble: bool = False,
+            slab_size: int = None,
+            spill_dir: str = None
             ):
         """
         Perform postprocessing and writes simpleITK Image
@@ -109,32 +306,60 @@ class LungPostProcessor:
             organ_name_nodules_prefix (str): base name of the output mask from nnUNet for Task777_CT_Nodules
             organ_name_nodules_prefix (str): base name of the output mask from nnUNet for Task775_CT_NSCLC_RG
             lung_label (str): label of lung assigned in AIMI dataset
+            num_folds (int, optional): Number of folds for ensemble. Default is 5.
+            fold_votes (FoldVotes, optional): votes already collected while the folds were
+                inferred. When missing, the fold predictions are read from save_path.
+            ct_geometry (DotDict, optional): CT geometry known from ingestion. When missing,
+                it is read from the header of ct_path.
+            fold_ext (str, optional): extension of the fold predictions, ".nii" intermediates are memory-mapped
+            network_ensemble (bool, optional): the folds were already ensembled on the network grid
+                into "<prefix>_ensemble<fold_ext>" label maps (see FoldVotes.label_map)
+            slab_size (int, optional): axial slices ensembled at a time when fold_votes is missing
+            spill_dir (str, optional): dir to spill the fold votes to when fold_votes is missing
         Returns:
             None
         """
         nodules_seg_absent = not os.path.isfile(output_nodules_seg_path)
         lesions_seg_absent = not os.path.isfile(output_lesions_seg_path)
-        if nodules_seg_absent or lesions_seg_absent:
-            lungs = self.get_lungs(save_path, lesion_prefix=organ_name_nsclc_rg_prefix)
+        if not (nodules_seg_absent or lesions_seg_absent):
+            return
+        if network_ensemble:
+            lesions_map = open_volume(get_path(save_path, f"{organ_name_nsclc_rg_prefix}_ensemble{fold_ext}"))
+            nodules_map = open_volume(get_path(save_path, f"{organ_name_nodules_prefix}_ensemble{fold_ext}"))
+            lungs = self.n_connected((lesions_map >= 1).astype(np.uint8))
+            nodules = (nodules_map == 2).astype(np.uint8)
+            lesions = (lesions_map == 2).astype(np.uint8)
+        else:
+            if fold_votes is None:
+                fold_votes = FoldVotes(lung_label, slab_size=slab_size, spill_dir=spill_dir)
+                for fold_idx in range(num_folds):
+                    fold_votes.add_fold_file(
+                        get_path(save_path, f"{organ_name_nsclc_rg_prefix}_{fold_idx}{fold_ext}"), is_nodules=False
+                        )
+            lungs = fold_votes.ensemble("lungs", num_folds=num_folds, th=0.6)
             lungs = self.n_connected(lungs)
-            nodules = self.get_ensemble(
-                save_path=save_path,
-                organ_name_prefix=organ_name_nodules_prefix,
-                label=lung_label,
-                num_folds=5,
-                th=0.6
-                )
-            lesions = self.get_ensemble(
-                save_path=save_path,
-                organ_name_prefix=organ_name_nsclc_rg_prefix,
-                label=lung_label,
-                num_folds=5,
-                th=0.6
-                )
-            nodules[lungs == 0] = 0
-            lesions[lungs == 0] = 0
-            nodules_seg_img = self.get_seg_img(np.copy(lungs), np.copy(nodules), ct_path)
-            lesions_seg_img = self.get_seg_img(np.copy(lungs), np.copy(lesions), ct_path)
-            sitk.WriteImage(nodules_seg_img, output_nodules_seg_path)
-            sitk.WriteImage(lesions_seg_img, output_lesions_seg_path)
+            if "nodules" not in fold_votes.votes:
+                # nodules outside the lungs are dropped anyway, only read the lung region
+                lung_roi = self.get_roi(lungs)
+                for fold_idx in range(num_folds):
+                    fold_votes.add_fold_file(
+                        get_path(save_path, f"{organ_name_nodules_prefix}_{fold_idx}{fold_ext}"),
+                        is_nodules=True,
+                        roi=lung_roi
+                        )
+            nodules = fold_votes.ensemble("nodules", num_folds=num_folds, th=0.6)
+            lesions = fold_votes.ensemble("lesions", num_folds=num_folds, th=0.6)
+        nodules[lungs == 0] = 0
+        lesions[lungs == 0] = 0
+        geometry = ct_geometry if ct_geometry is not None else self.get_ct_geometry(ct_path)
+        nodules_seg_img = self.get_seg_img(lungs, nodules, geometry=geometry)
+        lesions_seg_img = self.get_seg_img(lungs, lesions, geometry=geometry)
+        with atomic_output(output_nodules_seg_path) as tmp_path:
+            sitk.WriteImage(nodules_seg_img, tmp_path)
+        with atomic_output(output_lesions_seg_path) as tmp_path:
+            sitk.WriteImage(lesions_seg_img, tmp_path)
+
+        # measure the components while the masks are still in memory
+        self.write_lesion_table(self.measure_lesions(nodules, lungs, geometry), output_nodules_seg_path)
+        self.write_lesion_table(self.measure_lesions(lesions, lungs, geometry), output_lesions_seg_path)
 
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import pickle
+import numpy as np
+from io_utils import DotDict, atomic_output
+
+
+GiB = 1 << 30
+# interpreter, torch, nnUNet and SimpleITK of one process before any volume is loaded
+PROCESS_OVERHEAD_BYTES = 1 * GiB
+# fp32 weights of a 3d_fullres Generic_UNet (~31M parameters) and the conv workspaces
+MODEL_BYTES = 512 << 20
+# float32 feature maps alive per patch voxel during a forward pass: 32 base features,
+# kept for the skip connections, and as much again for the decoder
+ACTIVATION_BYTES_PER_PATCH_VOXEL = 4 * 64
+
+
+def read_ct_header(dicom_index, series_uid):
+    """
+    CT shape (z, y, x) and spacing from the dicom index, without touching any pixel data
+    """
+    instances = dicom_index.instances(series_uid)
+    if not instances or instances[0].rows is None or instances[0].pixel_spacing is None:
+        raise ValueError(f"series {series_uid} has no image geometry")
+    first = instances[0]
+    positions = [x.slice_position for x in instances if x.slice_position is not None]
+    if len(positions) > 1:
+        slice_spacing = float(np.median(np.abs(np.diff(positions))))
+    else:
+        slice_spacing = first.slice_thickness or 1.0
+    return DotDict({
+        "shape": (len(instances), int(first.rows), int(first.columns)),
+        "spacing": (slice_spacing, float(first.pixel_spacing[0]), float(first.pixel_spacing[1])),
+    })
+
+
+def load_task_plans(checkpoint_path):
+    """
+    The parts of the nnUNet plans of a task that determine its memory use
+    """
+    with open(os.path.join(checkpoint_path, "plans.pkl"), "rb") as f:
+        plans = pickle.load(f)
+    # 3d_fullres runs the last, full resolution stage
+    stage_plans = plans["plans_per_stage"][len(plans["plans_per_stage"]) - 1]
+    return DotDict({
+        "target_spacing": tuple(float(x) for x in stage_plans["current_spacing"]),
+        "patch_size": tuple(int(x) for x in stage_plans["patch_size"]),
+        "transpose_forward": tuple(int(x) for x in plans["transpose_forward"]),
+        "num_classes": int(plans["num_classes"]) + 1,
+        "num_modalities": int(plans["num_modalities"]),
+    })
+
+
+def estimate_task_memory(ct, task_plans):
+    """
+    Peak bytes of the stages of one task for a CT, from its header and the task plans.
+
+    Returns:
+        DotDict: voxel counts on the CT and network grids, and peak bytes per stage.
+            infer is keyed by accumulator dtype.
+    """
+    n_ct = int(np.prod(ct.shape))
+    shape = np.asarray(ct.shape, dtype=np.float64)[list(task_plans.transpose_forward)]
+    spacing = np.asarray(ct.spacing, dtype=np.float64)[list(task_plans.transpose_forward)]
+    network_shape = np.maximum(np.ceil(shape * spacing / np.asarray(task_plans.target_spacing)), task_plans.patch_size)
+    n_net = int(np.prod(network_shape))
+    c = task_plans.num_classes
+    network_input = n_net * task_plans.num_modalities * 4
+    forward = MODEL_BYTES + int(np.prod(task_plans.patch_size)) * ACTIVATION_BYTES_PER_PATCH_VOXEL
+    return DotDict({
+        "ct_voxels": n_ct,
+        "network_voxels": n_net,
+        "network_input": network_input,
+        # float32 CT, its crop and the float64 resampling output
+        "preprocess": n_ct * 4 * 2 + n_net * 8 + network_input,
+        # summed softmax and prediction weights, then the class probabilities
+        "infer": {
+            "float32": network_input + forward + 2 * c * n_net * 4 + n_net * 4,
+            "float16": network_input + forward + 2 * c * n_net * 2 + n_net * 2,
+        },
+        # nnUNet resamples the softmax in float64, per channel, then takes the argmax
+        "export": c * n_net * 8 + c * n_ct * 8 + n_ct * 8,
+        "export_network_space": n_net * 2,
+    })
+
+
+def estimate_postprocessing_memory(ct, slab_size=None, spill=False):
+    """
+    Peak bytes of LungPostProcessor.postprocessing: the uint8 fold votes, the float64
+    ensemble division (whole volume or per slab), the masks and the int64 labels of
+    the connected component filtering.
+    """
+    n_ct = int(np.prod(ct.shape))
+    slice_voxels = n_ct // ct.shape[0]
+    votes = 0 if spill else 3 * n_ct
+    division = n_ct * 8 if slab_size is None else min(slab_size, ct.shape[0]) * slice_voxels * 8
+    return votes + division + 3 * n_ct + 2 * n_ct * 8
+
+
+def format_bytes(n):
+    return f"{n / GiB:.2f} GiB"
+
+
+def plan_run(
+        ct,
+        task_plans,
+        memory_budget_bytes,
+        num_workers=0,
+        max_parallel_stages=2,
+        intermediate_format="nii",
+        network_space=False,
+        ):
+    """
+    Choose fold workers, accumulator precision, postprocessing slab size and whether
+    to spill the ensemble votes to disk so the estimated peak stays under the budget.
+    Every decision is printed with the estimate it is based on.
+
+    Args:
+        ct (DotDict): shape and spacing, see read_ct_header
+        task_plans (list): plans of both tasks, see load_task_plans
+        memory_budget_bytes (int): memory the run may use
+        num_workers (int, optional): requested fold worker processes
+        max_parallel_stages (int, optional): requested concurrent pipeline stages
+        intermediate_format (str, optional): requested format of the intermediates
+        network_space (bool, optional): the folds are ensembled on the network grid
+
+    Returns:
+        DotDict: the plan, with the settings to run with and the decisions taken
+    """
+    decisions = []
+
+    def decide(message):
+        print(f"memory plan: {message}")
+        decisions.append(message)
+
+    budget = memory_budget_bytes - PROCESS_OVERHEAD_BYTES
+    estimates = [estimate_task_memory(ct, x) for x in task_plans]
+    decide(
+        f"CT {ct.shape} at {tuple(round(x, 3) for x in ct.spacing)} mm, "
+        f"network grid {[x.network_voxels for x in estimates]} voxels, budget {format_bytes(memory_budget_bytes)}"
+    )
+    export_key = "export_network_space" if network_space else "export"
+
+    def fold_peak(dtype):
+        return max(x.infer[dtype] + x[export_key] for x in estimates)
+
+    # accumulator precision
+    accumulator_dtype = None
+    if fold_peak("float32") > budget:
+        accumulator_dtype = "float16"
+        decide(
+            f"float32 accumulators need {format_bytes(fold_peak('float32'))} per fold, "
+            f"using float16 ({format_bytes(fold_peak('float16'))})"
+        )
+    else:
+        decide(f"float32 accumulators fit, {format_bytes(fold_peak('float32'))} per fold")
+    per_fold = fold_peak(accumulator_dtype or "float32")
+
+    # fold parallelism
+    folds_peak = per_fold
+    if num_workers > 0:
+        # the parent holds the preprocessed CT of both tasks in shared memory
+        shared = sum(x.network_input for x in estimates)
+        fit = max(0, int((budget - shared) // (per_fold + PROCESS_OVERHEAD_BYTES)))
+        planned_workers = min(num_workers, fit)
+        if planned_workers < num_workers:
+            decide(
+                f"{num_workers} fold workers need {format_bytes(shared + num_workers * (per_fold + PROCESS_OVERHEAD_BYTES))}, "
+                f"using {planned_workers}" + (" (sequential folds)" if planned_workers == 0 else "")
+            )
+        else:
+            decide(f"{num_workers} fold workers fit")
+        num_workers = planned_workers
+        if num_workers > 0:
+            folds_peak = shared + num_workers * (per_fold + PROCESS_OVERHEAD_BYTES)
+    # fold inferences never overlap other fold stages, parallel stages only overlap
+    # the ensembles and SEG exports, which are small next to a fold
+    decide(f"{max_parallel_stages} concurrent stages kept, fold inferences run one stage at a time")
+
+    # postprocessing slab size and spilling
+    slab_size = None
+    spill = False
+    postprocessing = estimate_postprocessing_memory(ct)
+    if postprocessing > budget:
+        slice_bytes = int(np.prod(ct.shape[1:])) * 8
+        fixed = estimate_postprocessing_memory(ct, slab_size=0)
+        slab_size = int((budget - fixed) // slice_bytes)
+        if slab_size < 1:
+            spill = True
+            fixed = estimate_postprocessing_memory(ct, slab_size=0, spill=True)
+            slab_size = max(1, int((budget - fixed) // slice_bytes))
+            decide("ensemble votes don't fit in memory, spilling them to disk")
+        slab_size = min(slab_size, ct.shape[0])
+        decide(
+            f"postprocessing needs {format_bytes(postprocessing)} on the whole volume, "
+            f"ensembling in slabs of {slab_size} slices"
+        )
+        postprocessing = estimate_postprocessing_memory(ct, slab_size=slab_size, spill=spill)
+    else:
+        decide(f"postprocessing fits, {format_bytes(postprocessing)}")
+    if spill and intermediate_format != "nii":
+        intermediate_format = "nii"
+        decide("writing uncompressed intermediates so the fold predictions are memory-mapped")
+
+    peak = PROCESS_OVERHEAD_BYTES + max(
+        max(x.preprocess for x in estimates), folds_peak, postprocessing
+    )
+    if peak > memory_budget_bytes:
+        decide(f"estimated peak {format_bytes(peak)} still exceeds the budget")
+    else:
+        decide(f"estimated peak {format_bytes(peak)}")
+
+    return DotDict({
+        "num_workers": num_workers,
+        "max_parallel_stages": max_parallel_stages,
+        "accumulator_dtype": accumulator_dtype,
+        "slab_size": slab_size,
+        "spill": spill,
+        "intermediate_format": intermediate_format,
+        "estimated_peak_bytes": int(peak),
+        "decisions": decisions,
+    })
+
+
+def write_plan(plan, plan_path):
+    with atomic_output(plan_path) as tmp_path:
+        with open(tmp_path, "w") as f:
+            json.dump(plan, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plan the memory use of a run from the dicom headers")
+    parser.add_argument("dcm_dir", help="dir containing the dcm files of the series")
+    parser.add_argument("--memory_budget_gb", type=float, required=True)
+    parser.add_argument("--num_workers", type=int, default=0)
+    parser.add_argument("--max_parallel_stages", type=int, default=2)
+    parser.add_argument("--index_dir", default="/tmp", help="dir to persist the dicom index in")
+    args = parser.parse_args()
+
+    from dicom_index import get_dicom_index
+    from run import get_model_paths
+
+    dicom_index = get_dicom_index(args.dcm_dir, args.index_dir)
+    ct = read_ct_header(dicom_index, dicom_index.primary_series_uid())
+    plan = plan_run(
+        ct,
+        [load_task_plans(x) for x in get_model_paths()],
+        int(args.memory_budget_gb * GiB),
+        num_workers=args.num_workers,
+        max_parallel_stages=args.max_parallel_stages,
+    )
+    print(json.dumps(plan, indent=2))
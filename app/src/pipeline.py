@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from io_utils import StageTimer
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """
+    sha256 of a file's content
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Stage:
+    """
+    A pipeline step with declared dependencies and outputs.
+
+    Args:
+        name (str): unique stage name, used as key in the manifest
+        fn (callable): called with the results of the dependencies, as a dict keyed by stage name
+        outputs (list, optional): files written by the stage. None means fn returns the
+            list of files it wrote, for stages whose outputs are only known after running.
+        deps (list, optional): names of the stages that have to complete first
+        signature (callable, optional): returns a json-serializable description of the inputs
+            that are not outputs of other stages, e.g. the source files of the first stage
+    """
+
+    def __init__(self, name, fn, outputs=None, deps=(), signature=None):
+        self.name = name
+        self.fn = fn
+        self.outputs = [str(x) for x in outputs] if outputs is not None else None
+        self.deps = list(deps)
+        self.signature = signature
+
+
+class Manifest:
+    """
+    Record of the completed stages and the content hashes of their outputs, persisted as json.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.lock = threading.Lock()
+        self.stages = {}
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, "r") as f:
+                self.stages = json.load(f)
+
+    def _file_record(self, path):
+        stat = os.stat(path)
+        return {"sha256": hash_file(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def _output_matches(self, path, record):
+        if not os.path.isfile(path):
+            return False
+        stat = os.stat(path)
+        if stat.st_size == record["size"] and stat.st_mtime_ns == record["mtime_ns"]:
+            return True
+        return hash_file(path) == record["sha256"]
+
+    def input_hashes(self, stage):
+        inputs = {
+            path: record["sha256"]
+            for dep in stage.deps
+            for path, record in self.stages.get(dep, {}).get("outputs", {}).items()
+        }
+        if stage.signature is not None:
+            signature = json.dumps(stage.signature(), sort_keys=True).encode("utf-8")
+            inputs["signature"] = hashlib.sha256(signature).hexdigest()
+        return inputs
+
+    def is_complete(self, stage):
+        """
+        A stage is complete if it was recorded with the same inputs and all of its outputs
+        are still on disk with the recorded content.
+        """
+        entry = self.stages.get(stage.name)
+        if entry is None or entry["inputs"] != self.input_hashes(stage):
+            return False
+        return all(self._output_matches(path, record) for path, record in entry["outputs"].items())
+
+    def record(self, stage, outputs):
+        entry = {
+            "inputs": self.input_hashes(stage),
+            "outputs": {path: self._file_record(path) for path in outputs},
+        }
+        with self.lock:
+            self.stages[stage.name] = entry
+            tmp_path = self.manifest_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.stages, f, indent=2)
+            os.replace(tmp_path, self.manifest_path)
+
+
+class Pipeline:
+    """
+    Runs a DAG of stages, independent stages concurrently on a thread pool. Completed stages
+    are recorded in a manifest, so an interrupted run resumes from the last completed stage.
+
+    Args:
+        manifest_path (str): where to persist the manifest
+        max_workers (int, optional): number of stages allowed to run at the same time
+        stage_timer (StageTimer, optional): collects the time spent per stage
+    """
+
+    def __init__(self, manifest_path, max_workers=2, stage_timer=None):
+        self.manifest = Manifest(manifest_path)
+        self.max_workers = max_workers
+        self.stage_timer = stage_timer if stage_timer is not None else StageTimer()
+        self.stages = {}
+
+    def add_stage(self, name, fn, outputs=None, deps=(), signature=None):
+        if name in self.stages:
+            raise ValueError(f"duplicate stage: {name}")
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"stage {name} depends on unknown stage {dep}")
+        self.stages[name] = Stage(name, fn, outputs=outputs, deps=deps, signature=signature)
+
+    def _run_stage(self, stage, results):
+        if self.manifest.is_complete(stage):
+            print(f"stage {stage.name} already complete, skipping")
+            return None
+        # anything left over from an interrupted attempt is stale
+        for path in stage.outputs or []:
+            if os.path.isfile(path):
+                os.remove(path)
+        with self.stage_timer.stage(stage.name):
+            result = stage.fn({dep: results.get(dep) for dep in stage.deps})
+        outputs = stage.outputs if stage.outputs is not None else [str(x) for x in result]
+        missing = [path for path in outputs if not os.path.isfile(path)]
+        if missing:
+            raise RuntimeError(f"stage {stage.name} did not write {missing}")
+        self.manifest.record(stage, outputs)
+        return result
+
+    def run(self):
+        """
+        Run all stages. Returns the results of the stages that ran, keyed by stage name;
+        stages skipped on resume have a result of None.
+        """
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                ready = [
+                    stage for stage in pending.values()
+                    if all(dep in results for dep in stage.deps)
+                ]
+                for stage in ready:
+                    del pending[stage.name]
+                    running[executor.submit(self._run_stage, stage, results)] = stage
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    # re-raises the first failure, stages already running are left to finish
+                    results[stage.name] = future.result()
+        return results
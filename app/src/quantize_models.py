@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import argparse
+import glob
+import json
+import os
+import numpy as np
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from bamf_nnunet_inference import (
+    QUANTIZED_ENGINE,
+    BAMFnnUNetInference,
+    QuantizedNetwork,
+    get_quantization_report_path,
+    get_quantized_path,
+    preprocess_for_task,
+)
+from io_utils import DotDict, atomic_output
+from run import get_model_paths
+
+
+def list_volumes(volume_dir):
+    """
+    CT volumes (nifti) in a directory
+    """
+    return sorted(glob.glob(os.path.join(volume_dir, "*.nii.gz")) + glob.glob(os.path.join(volume_dir, "*.nii")))
+
+
+def get_patches(data, patch_size, num_patches):
+    """
+    Patches of the network input size, evenly spaced along the first axis through the
+    center of a preprocessed volume, padded where the volume is smaller than a patch.
+    """
+    pad = [(0, 0)] + [(0, max(0, p - s)) for p, s in zip(patch_size, data.shape[1:])]
+    data = np.pad(data, pad, mode="constant")
+    starts = [max(0, (s - p) // 2) for p, s in zip(patch_size, data.shape[1:])]
+    for z in np.linspace(0, data.shape[1] - patch_size[0], num_patches).astype(int):
+        yield data[
+            :,
+            z:z + patch_size[0],
+            starts[1]:starts[1] + patch_size[1],
+            starts[2]:starts[2] + patch_size[2],
+        ]
+
+
+def load_fold(checkpoint_path, fold):
+    model = BAMFnnUNetInference()
+    model.initialize(DotDict({"checkpoint_path": checkpoint_path, "fold": fold, "predict_aug": False}))
+    return model
+
+
+def quantize_fold(checkpoint_path, fold, calibration_patches):
+    """
+    Static post-training quantization of the convolutions of one fold network with
+    torch.ao FX, calibrated on the given patches. The int8 network is saved as TorchScript.
+    Returns the path of the int8 network.
+    """
+    torch.backends.quantized.engine = QUANTIZED_ENGINE
+    trainer = load_fold(checkpoint_path, fold).trainer
+    network = trainer.network.cpu().eval()
+    # inference only uses the full resolution output
+    network.do_ds = False
+    example_inputs = (torch.zeros((1, trainer.num_input_channels, *trainer.patch_size)),)
+    prepared = prepare_fx(network, get_default_qconfig_mapping(QUANTIZED_ENGINE), example_inputs)
+    with torch.no_grad():
+        for patch in calibration_patches:
+            prepared(torch.from_numpy(np.ascontiguousarray(patch[None])).float())
+        quantized = torch.jit.trace(convert_fx(prepared), example_inputs)
+
+    quantized_path = get_quantized_path(checkpoint_path, fold)
+    with atomic_output(quantized_path) as tmp_path:
+        torch.jit.save(quantized, tmp_path)
+    # a report of the previous int8 network doesn't hold for this one
+    report_path = get_quantization_report_path(checkpoint_path, fold)
+    if os.path.isfile(report_path):
+        os.remove(report_path)
+    return quantized_path
+
+
+def dice(a, b):
+    denominator = a.sum() + b.sum()
+    return 1.0 if denominator == 0 else 2.0 * np.logical_and(a, b).sum() / denominator
+
+
+def validate_fold(checkpoint_path, fold, validation_data):
+    """
+    Compare the masks of the int8 and fp32 networks of one fold on preprocessed validation
+    volumes and write the mean Dice per class to the report the inference guard reads.
+    Returns the report.
+    """
+    fp32_model = load_fold(checkpoint_path, fold)
+    int8_model = load_fold(checkpoint_path, fold)
+    int8_model.trainer.network = QuantizedNetwork(
+        int8_model.trainer.network, get_quantized_path(checkpoint_path, fold)
+    )
+
+    scores = {}
+    for data in validation_data:
+        fp32_mask = fp32_model.inference(data).argmax(0)
+        int8_mask = int8_model.inference(data).argmax(0)
+        for label in range(1, fp32_model.trainer.num_classes):
+            scores.setdefault(label, []).append(dice(fp32_mask == label, int8_mask == label))
+
+    dice_per_class = {str(label): float(np.mean(values)) for label, values in scores.items()}
+    report = {
+        "engine": QUANTIZED_ENGINE,
+        "num_volumes": len(validation_data),
+        "dice": dice_per_class,
+        "max_dice_drop": max(1.0 - x for x in dice_per_class.values()) if dice_per_class else 0.0,
+    }
+    with atomic_output(get_quantization_report_path(checkpoint_path, fold)) as tmp_path:
+        with open(tmp_path, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def calibrate(calibration_dir, num_folds=5, patches_per_volume=4):
+    volumes = list_volumes(calibration_dir)
+    if not volumes:
+        raise ValueError(f"no calibration volumes in {calibration_dir}")
+    for checkpoint_path in get_model_paths():
+        # all folds of a task share the preprocessing, so the patches are reused for every fold
+        trainer = load_fold(checkpoint_path, 0).trainer
+        calibration_patches = []
+        for volume in volumes:
+            data, _ = preprocess_for_task(checkpoint_path, volume)
+            calibration_patches += [x.copy() for x in get_patches(data, trainer.patch_size, patches_per_volume)]
+        for fold_idx in range(num_folds):
+            print(f"quantized {quantize_fold(checkpoint_path, fold_idx, calibration_patches)}")
+
+
+def validate(validation_dir, num_folds=5, max_dice_drop=None):
+    volumes = list_volumes(validation_dir)
+    if not volumes:
+        raise ValueError(f"no validation volumes in {validation_dir}")
+    for checkpoint_path in get_model_paths():
+        validation_data = [preprocess_for_task(checkpoint_path, volume)[0] for volume in volumes]
+        for fold_idx in range(num_folds):
+            report = validate_fold(checkpoint_path, fold_idx, validation_data)
+            status = ""
+            if max_dice_drop is not None:
+                status = "accepted" if report["max_dice_drop"] <= max_dice_drop else "refused"
+            print(f"{checkpoint_path} fold {fold_idx}: Dice per class {report['dice']} {status}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quantize the fold networks to int8 and validate them against fp32")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    calibrate_parser = subparsers.add_parser("calibrate", help="quantize every fold, calibrated on local CTs")
+    calibrate_parser.add_argument("calibration_dir", help="directory of CT nifti files")
+    calibrate_parser.add_argument("--num_folds", type=int, default=5)
+    calibrate_parser.add_argument("--patches_per_volume", type=int, default=4)
+    validate_parser = subparsers.add_parser("validate", help="compare int8 and fp32 masks, Dice per class")
+    validate_parser.add_argument("validation_dir", help="directory of CT nifti files")
+    validate_parser.add_argument("--num_folds", type=int, default=5)
+    validate_parser.add_argument("--max_dice_drop", type=float, default=None)
+    args = parser.parse_args()
+
+    if args.command == "calibrate":
+        calibrate(args.calibration_dir, num_folds=args.num_folds, patches_per_volume=args.patches_per_volume)
+    else:
+        validate(args.validation_dir, num_folds=args.num_folds, max_dice_drop=args.max_dice_drop)
@@ -1,13 +1,29 @@
+from timeit import default_timer as timer
+
+# reference point for the time to first voxel
+START_TIME = timer()
+
 import yaml
 import argparse
+import importlib
 import os
+import threading
 from pathlib import Path
-from converter_utils import DicomToNiiConverter, NiiToDicomConverter
-from bamf_nnunet_inference import BAMFnnUNetInference
-from lung_processor import LungPostProcessor
-from io_utils import DotDict, get_path
+from intermediate_store import get_export_info_path, get_sidecar_path, write_geometry_sidecar
+from io_utils import DotDict, StageTimer, atomic_output, get_lesion_table_path, get_path
+from pipeline import Pipeline
 import shutil
 
+# torch, nnunet, SimpleITK and skimage are only imported by the stages that use them,
+# so a config error or a fully resumed run fails or finishes without loading them
+REQUIRED_ENV = [
+    "WEIGHTS_FOLDER_NODULES",
+    "WEIGHTS_FOLDER_NSCLC_RG",
+    "TASK_NAME_NODULES",
+    "TASK_NAME_NSCLC_RG",
+    "DCMQI_PACKAGE_PATH",
+]
+
 
 def load_config(config_path):
     with open(config_path, 'r') as config_file:
@@ -15,140 +31,572 @@ def load_config(config_path):
     return config
 
 
-def run_nnunet(source_ct_dir, target_dir, output_nodules_seg_name, output_lesions_seg_name, num_folds=5, organ_label=9):
+def validate_config(config):
     """
-    Convert list of dcm files to a single nii.gz file
-    :param: source_ct_dir - dir containing list of dcm files
-    :param: target_dir - dir to write segmented dcm masks too
-    :param: num_folds - number of folds the nnUNet model was trained for
-    :param: organ_label - label of lung segment in AIMI dataset    
-    """    
-    temp_nii_dir = "/tmp/nii-input"
-    Path(temp_nii_dir).mkdir(parents=True, exist_ok=True)
-    temp_ct_path = get_path(temp_nii_dir, "ct_0000.nii.gz")
+    Check the config and the environment before anything heavy is loaded.
+    Raises ValueError listing every problem found.
+    """
+    errors = []
+    general = config.get("general") or {}
+    nnunet_runner = (config.get("modules") or {}).get("NNUnetRunner")
+    if not general.get("data_base_dir"):
+        errors.append("general.data_base_dir is required")
+    if nnunet_runner is None:
+        raise ValueError("invalid config: modules.NNUnetRunner is required")
+
+    for key in ["source_ct_dir", "target_dir", "output_nodules_seg_name", "output_lesions_seg_name", "num_folds", "organ_label"]:
+        if nnunet_runner.get(key) in (None, ""):
+            errors.append(f"NNUnetRunner.{key} is required")
+    for key, minimum in [("num_folds", 1), ("organ_label", 0), ("num_workers", 0), ("threads_per_worker", 1), ("max_parallel_stages", 1)]:
+        value = nnunet_runner.get(key)
+        if value is None:
+            continue
+        try:
+            if int(value) < minimum:
+                errors.append(f"NNUnetRunner.{key} must be >= {minimum}, got {value}")
+        except (TypeError, ValueError):
+            errors.append(f"NNUnetRunner.{key} must be an integer, got {value!r}")
+    for key in ["output_nodules_seg_name", "output_lesions_seg_name"]:
+        value = nnunet_runner.get(key)
+        if value and not str(value).endswith((".nii.gz", ".nii")):
+            errors.append(f"NNUnetRunner.{key} must be a .nii.gz or .nii file name, got {value}")
+    if nnunet_runner.get("intermediate_format", "nii") not in ("nii", "nii.gz"):
+        errors.append(f"NNUnetRunner.intermediate_format must be nii or nii.gz, got {nnunet_runner.get('intermediate_format')}")
+    if nnunet_runner.get("ensemble_space", "original") not in ("original", "network"):
+        errors.append(f"NNUnetRunner.ensemble_space must be original or network, got {nnunet_runner.get('ensemble_space')}")
+    if nnunet_runner.get("precision", "fp32") not in ("fp32", "int8"):
+        errors.append(f"NNUnetRunner.precision must be fp32 or int8, got {nnunet_runner.get('precision')}")
+    try:
+        if not 0 <= float(nnunet_runner.get("int8_max_dice_drop", 0.02)) <= 1:
+            errors.append("NNUnetRunner.int8_max_dice_drop must be between 0 and 1")
+    except (TypeError, ValueError):
+        errors.append(f"NNUnetRunner.int8_max_dice_drop must be a number, got {nnunet_runner.get('int8_max_dice_drop')!r}")
+    if nnunet_runner.get("memory_budget_gb") is not None:
+        try:
+            if float(nnunet_runner["memory_budget_gb"]) <= 0:
+                errors.append("NNUnetRunner.memory_budget_gb must be > 0")
+        except (TypeError, ValueError):
+            errors.append(f"NNUnetRunner.memory_budget_gb must be a number, got {nnunet_runner['memory_budget_gb']!r}")
+    if general.get("data_base_dir") and nnunet_runner.get("source_ct_dir"):
+        source_ct_dir = os.path.join(general["data_base_dir"], nnunet_runner["source_ct_dir"])
+        if not os.path.isdir(source_ct_dir):
+            errors.append(f"source_ct_dir {source_ct_dir} does not exist")
+
+    missing_env = [name for name in REQUIRED_ENV if name not in os.environ]
+    errors += [f"environment variable {name} is not set" for name in missing_env]
+    if not missing_env:
+        for model_path in get_model_paths():
+            if not os.path.isdir(model_path):
+                errors.append(f"model folder {model_path} does not exist")
+
+    if errors:
+        raise ValueError("invalid config:\n" + "\n".join(f"  - {e}" for e in errors))
 
-    temp_folds_dir = "/tmp/folds"
-    Path(temp_folds_dir).mkdir(parents=True, exist_ok=True)
 
-    # Prepare config for nnUNet models for nodules and nsclc_rg
+def get_model_paths():
+    """
+    Resolve the nnUNet model folders for Task777_CT_Nodules and Task775_CT_NSCLC_RG
+    from the environment set up in the Dockerfile.
+    """
     WEIGHTS_FOLDER_NODULES = os.environ["WEIGHTS_FOLDER_NODULES"]
     WEIGHTS_FOLDER_NSCLC_RG = os.environ["WEIGHTS_FOLDER_NSCLC_RG"]
     TASK_NAME_NODULES = os.environ["TASK_NAME_NODULES"]
     TASK_NAME_NSCLC_RG = os.environ["TASK_NAME_NSCLC_RG"]
     model_path_nodules = get_path(WEIGHTS_FOLDER_NODULES, f"3d_fullres/{TASK_NAME_NODULES}/nnUNetTrainerV2__nnUNetPlansv2.1")
     model_path_nsclc_rg = get_path(WEIGHTS_FOLDER_NSCLC_RG, f"3d_fullres/{TASK_NAME_NSCLC_RG}/nnUNetTrainerV2__nnUNetPlansv2.1")
-    nnunet_inference_model = BAMFnnUNetInference()
+    return model_path_nodules, model_path_nsclc_rg
 
-    # convert dcm to nii
-    converter = DicomToNiiConverter()
-    converter.dcm_to_nii(source_ct_dir, temp_ct_path)
 
-    #################################################
-    # Infer using nnUNet model across all folds     #
-    # for Task777_CT_Nodules                        #
-    #################################################
-    organ_name_nodules_prefix = "ct_nodules_fold"
-    for fold_idx in range(num_folds):
-        organ_name_nodules_prefix_fold = f"{organ_name_nodules_prefix}_{fold_idx}"
-        context = {
-            'checkpoint_path': model_path_nodules,
-            'input_file': temp_ct_path,
-            'pt_file': None,
-            'prediction_save': temp_folds_dir,
-            'predict_aug': False,
-            'softmax': False,
-            'organ_name': organ_name_nodules_prefix_fold,
-            'fold': fold_idx,
+def get_runner_args(config):
+    """
+    Build the keyword arguments of run_nnunet from the NNUnetRunner section of a config
+    """
+    general = config.get("general", {})
+    data_base_dir = general.get("data_base_dir")
+    modules = config.get("modules", {})
+    nnunet_runner = modules.get("NNUnetRunner", {})
+    source_ct_dir = nnunet_runner.get("source_ct_dir")
+    source_ct_dir = os.path.join(data_base_dir, source_ct_dir)
+    target_dir = nnunet_runner.get("target_dir")
+    target_dir = os.path.join(data_base_dir, target_dir)
+    return {
+        "source_ct_dir": source_ct_dir,
+        "target_dir": target_dir,
+        "output_nodules_seg_name": nnunet_runner.get("output_nodules_seg_name"),
+        "output_lesions_seg_name": nnunet_runner.get("output_lesions_seg_name"),
+        "num_folds": int(nnunet_runner.get("num_folds")),
+        "organ_label": int(nnunet_runner.get("organ_label")),
+        "num_workers": int(nnunet_runner.get("num_workers", 0)),
+        "threads_per_worker": int(nnunet_runner.get("threads_per_worker", 1)),
+        "intermediate_format": nnunet_runner.get("intermediate_format", "nii"),
+        "max_parallel_stages": int(nnunet_runner.get("max_parallel_stages", 2)),
+        "use_model_bundles": bool(nnunet_runner.get("use_model_bundles", True)),
+        "ensemble_space": nnunet_runner.get("ensemble_space", "original"),
+        "precision": nnunet_runner.get("precision", "fp32"),
+        "int8_max_dice_drop": float(nnunet_runner.get("int8_max_dice_drop", 0.02)),
+        "memory_budget_gb": (
+            float(nnunet_runner["memory_budget_gb"]) if nnunet_runner.get("memory_budget_gb") is not None else None
+        ),
+    }
+
+
+def copy_lesion_tables(seg_path, target_dir):
+    """
+    Ship the lesion measurement tables written by LungPostProcessor next to the output SEG.
+    Returns the copied files.
+    """
+    copied = []
+    for ext in ["json", "csv"]:
+        lesion_table_path = get_lesion_table_path(seg_path, ext)
+        if os.path.isfile(lesion_table_path):
+            copied.append(get_path(target_dir, os.path.basename(lesion_table_path)))
+            shutil.copyfile(lesion_table_path, copied[-1])
+    return copied
+
+
+def infer_folds_parallel(
+        units, temp_folds_dir, organ_label, num_workers, threads_per_worker, fold_ext, slab_size=None, spill_dir=None,
+        on_inference_start=None
+        ):
+    """
+    Infer the (task, fold) units on a FoldScheduler process pool and collect the ensemble
+    votes as each fold prediction lands.
+    """
+    from fold_scheduler import FoldScheduler
+    from lung_processor import FoldVotes
+
+    fold_votes = FoldVotes(organ_label, slab_size=slab_size, spill_dir=spill_dir)
+    scheduler = FoldScheduler(num_workers=num_workers, threads_per_worker=threads_per_worker)
+    for unit, seconds in scheduler.run(units, on_inference_start=on_inference_start):
+        print(f"inferred {unit['organ_name']} in {seconds:.1f}s")
+        output_seg_nii_path = get_path(temp_folds_dir, f"{unit['organ_name']}{fold_ext}")
+        fold_votes.add_fold_file(output_seg_nii_path, is_nodules=unit["is_nodules"])
+    return fold_votes
+
+
+# settings of a fold inference its prediction depends on
+FOLD_SIGNATURE_KEYS = [
+    "checkpoint_path",
+    "fold",
+    "output_ext",
+    "network_space",
+    "quantized",
+    "max_dice_drop",
+    "accumulator_dtype",
+    "use_bundle",
+]
+
+
+def get_fold_signature(context):
+    """
+    Signature of a fold inference for the pipeline manifest: its settings and the mtimes of
+    the plans and of every model file of the fold (checkpoint, bundle, int8 network and report),
+    so a rerun with other settings or models infers the fold again.
+    """
+    checkpoint_path = str(context["checkpoint_path"])
+    fold_dir = get_path(checkpoint_path, f"fold_{context['fold']}")
+    model_files = [get_path(checkpoint_path, "plans.pkl")]
+    if os.path.isdir(fold_dir):
+        model_files += sorted(get_path(fold_dir, name) for name in os.listdir(fold_dir))
+    signature = {key: context.get(key) for key in FOLD_SIGNATURE_KEYS}
+    signature["checkpoint_path"] = checkpoint_path
+    signature["model_files"] = {path: os.stat(path).st_mtime_ns for path in model_files if os.path.isfile(path)}
+    return signature
+
+
+def get_tasks():
+    """
+    (task name, model folder, fold prediction prefix, is nodules task) of both nnUNet tasks
+    """
+    model_path_nodules, model_path_nsclc_rg = get_model_paths()
+    return [
+        (os.environ["TASK_NAME_NODULES"], model_path_nodules, "ct_nodules_fold", True),
+        (os.environ["TASK_NAME_NSCLC_RG"], model_path_nsclc_rg, "ct_nsclc_rg_fold", False),
+    ]
+
+
+def ensemble_on_network_grid(
+        folds_dir, organ_name_prefix, is_nodules, organ_label, num_folds, output_ext, fold_votes=None, slab_size=None
+        ):
+    """
+    Ensemble the network grid fold predictions of a task and resample the resulting label
+    map to the CT once. Returns the path of "<prefix>_ensemble<output_ext>".
+    """
+    from bamf_nnunet_inference import save_network_segmentation
+    from lung_processor import FoldVotes
+
+    name = "nodules" if is_nodules else "lesions"
+    if fold_votes is None:
+        fold_votes = FoldVotes(organ_label, slab_size=slab_size)
+        for fold_idx in range(num_folds):
+            fold_votes.add_fold_file(
+                get_path(folds_dir, f"{organ_name_prefix}_{fold_idx}.npy"), is_nodules=is_nodules
+                )
+    ensemble_path = get_path(folds_dir, f"{organ_name_prefix}_ensemble{output_ext}")
+    save_network_segmentation(
+        fold_votes.label_map(name, num_folds=num_folds, with_lungs=not is_nodules),
+        get_export_info_path(get_path(folds_dir, f"{organ_name_prefix}_0.npy")),
+        ensemble_path,
+        )
+    return ensemble_path
+
+
+def export_seg(seg_path, seg_name, source_ct_dir, target_dir, dcm_ref_files=None):
+    """
+    Convert a final mask to a DICOM SEG in target_dir, falling back to shipping the nii file.
+    dcm_ref_files are the instances of the segmented series, all of source_ct_dir if None.
+    Returns the files written to target_dir.
+    """
+    from converter_utils import NiiToDicomConverter
+
+    dcmqi_package_path = os.environ["DCMQI_PACKAGE_PATH"]
+    converter = NiiToDicomConverter(dcmqi_package_path)
+    # Example seg_name: "seg_nodules_ensemble.nii.gz"
+    seg_name_dcm = seg_name.split('.')[0].strip() + ".dcm"
+    target_segmented_dcm_file = get_path(target_dir, seg_name_dcm)
+    success = converter.convert_nii_to_dcm(
+        nii_path=Path(seg_path),
+        dcm_ref_dir=Path(source_ct_dir),
+        dcm_out_file=Path(target_segmented_dcm_file),
+        dicom_seg_meta_json=Path("dicom_seg_meta.json"),
+        add_background_label=False,
+        dcm_ref_files=dcm_ref_files,
+    )
+    # Safety check: If dicom conversion fails, ship the nii file
+    if success:
+        written = [target_segmented_dcm_file]
+    else:
+        target_segmented_nii_file = get_path(target_dir, seg_name)
+        shutil.copyfile(seg_path, target_segmented_nii_file)
+        written = [target_segmented_nii_file]
+    return written + copy_lesion_tables(seg_path, target_dir)
+
+
+def run_nnunet(
+        source_ct_dir,
+        target_dir,
+        output_nodules_seg_name,
+        output_lesions_seg_name,
+        num_folds=5,
+        organ_label=9,
+        num_workers=0,
+        threads_per_worker=1,
+        intermediate_format="nii",
+        max_parallel_stages=2,
+        use_model_bundles=True,
+        ensemble_space="original",
+        precision="fp32",
+        int8_max_dice_drop=0.02,
+        memory_budget_gb=None,
+        work_dir="/tmp",
+        model_cache=None,
+        stage_timer=None,
+        start_time=None
+        ):
+    """
+    Convert list of dcm files to a single nii.gz file
+    :param: source_ct_dir - dir containing list of dcm files
+    :param: target_dir - dir to write segmented dcm masks too
+    :param: num_folds - number of folds the nnUNet model was trained for
+    :param: organ_label - label of lung segment in AIMI dataset
+    :param: num_workers - worker processes for the fold inferences, 0 infers the folds one after another
+    :param: threads_per_worker - torch intra-op threads of each worker process
+    :param: intermediate_format - "nii" keeps the CT and fold predictions uncompressed so they can be memory-mapped, "nii.gz" compresses them
+    :param: max_parallel_stages - number of independent pipeline stages run at the same time, fold
+        inferences of this process never overlap each other
+    :param: use_model_bundles - load the fold models from the bundles baked by bake_models.py when present
+    :param: ensemble_space - "original" resamples every fold prediction to the CT before the ensemble,
+        "network" ensembles the folds on the network grid and resamples once per task
+    :param: precision - "int8" runs the fold networks quantized by quantize_models.py on the CPU, "fp32" the original ones
+    :param: int8_max_dice_drop - largest Dice loss per class against fp32 for which a fold's int8 network is used
+    :param: memory_budget_gb - memory the run may use, the settings above are lowered to fit it
+        as planned by memory_planner.plan_run. None runs with the settings as given
+    :param: work_dir - scratch dir for the nii input, the fold predictions and the stage manifest
+    :param: model_cache - BAMFnnUNetModelCache holding already loaded fold models
+    :param: stage_timer - StageTimer collecting per-stage timings
+    :param: start_time - reference point of time_to_first_voxel, process start by default
+    :return: dict of per-stage timings in seconds
+    """
+    stage_timer = stage_timer if stage_timer is not None else StageTimer()
+    start_time = start_time if start_time is not None else START_TIME
+
+    model_cache_lock = threading.Lock()
+
+    def get_model_cache():
+        nonlocal model_cache
+        with model_cache_lock:
+            if model_cache is None:
+                from bamf_nnunet_inference import BAMFnnUNetModelCache
+
+                # by default only one fold model is held in memory at a time
+                model_cache = BAMFnnUNetModelCache(max_models=1)
+            return model_cache
+
+    # header index of the input series, persisted in the work dir and shared by conversion and export
+    series = None
+    series_lock = threading.Lock()
+
+    def get_series():
+        nonlocal series
+        with series_lock:
+            if series is None:
+                from dicom_index import get_dicom_index
+
+                index = get_dicom_index(source_ct_dir, work_dir)
+                series = (index, index.primary_series_uid())
+            return series
+
+    def get_series_files():
+        # dcmqi reads a single-series directory as is, the files are only needed to pick the series out of several
+        index, series_uid = get_series()
+        return index.files(series_uid) if len(index.series()) > 1 else None
+
+    def get_series_signature():
+        # the source series is the input of the first stage, a rerun on another series starts over
+        index, series_uid = get_series()
+        return {
+            "series_uid": series_uid,
+            "files": [[instance.path, instance.size, instance.mtime_ns] for instance in index.instances(series_uid)],
         }
-        context = DotDict(context)
-        print(f"inferring for fold {fold_idx} for task {TASK_NAME_NODULES}")
-        print(context)
-        # nnUNet creates below file internally. Format: temp_dir/ct_nodules_fold_0.nii.gz        
-        output_seg_nii_file = f"{organ_name_nodules_prefix_fold}.nii.gz"
-        output_seg_nii_path = get_path(temp_folds_dir, output_seg_nii_file)
-        if not os.path.isfile(output_seg_nii_path):
-            nnunet_inference_model.handle(context=context)
+
+    # plan the run from the CT header, before any pixel data is loaded
+    slab_size = None
+    spill_dir = None
+    accumulator_dtype = None
+    if memory_budget_gb is not None:
+        from memory_planner import GiB, load_task_plans, plan_run, read_ct_header, write_plan
+
+        index, series_uid = get_series()
+        memory_plan = plan_run(
+            read_ct_header(index, series_uid),
+            [load_task_plans(model_path) for model_path in get_model_paths()],
+            int(memory_budget_gb * GiB),
+            num_workers=num_workers,
+            max_parallel_stages=max_parallel_stages,
+            intermediate_format=intermediate_format,
+            network_space=ensemble_space == "network",
+            )
+        write_plan(memory_plan, get_path(work_dir, "memory_plan.json"))
+        num_workers = memory_plan.num_workers
+        max_parallel_stages = memory_plan.max_parallel_stages
+        intermediate_format = memory_plan.intermediate_format
+        accumulator_dtype = memory_plan.accumulator_dtype
+        slab_size = memory_plan.slab_size
+        if memory_plan.spill:
+            spill_dir = get_path(work_dir, "spill")
+            Path(spill_dir).mkdir(parents=True, exist_ok=True)
+
+    temp_nii_dir = get_path(work_dir, "nii-input")
+    Path(temp_nii_dir).mkdir(parents=True, exist_ok=True)
+    intermediate_ext = f".{intermediate_format}"
+    temp_ct_path = get_path(temp_nii_dir, f"ct_0000{intermediate_ext}")
+
+    # on the network grid the fold predictions are kept as raw label arrays
+    network_space = ensemble_space == "network"
+    fold_ext = ".npy" if network_space else intermediate_ext
+
+    def get_fold_outputs(organ_name):
+        fold_path = get_path(temp_folds_dir, f"{organ_name}{fold_ext}")
+        return [fold_path, get_export_info_path(fold_path)] if network_space else [fold_path]
+
+    temp_folds_dir = get_path(work_dir, "folds")
+    Path(temp_folds_dir).mkdir(parents=True, exist_ok=True)
+    Path(target_dir).mkdir(parents=True, exist_ok=True)
+
+    # completed stages are recorded in the manifest, a rerun in the same work_dir resumes from there
+    pipeline = Pipeline(
+        get_path(work_dir, "manifest.json"), max_workers=max_parallel_stages, stage_timer=stage_timer
+        )
+
+    # convert dcm to nii
+    ingested = {}
+
+    def convert_dcm_to_nii(_):
+        from converter_utils import DicomToNiiConverter
+
+        # the folds are inferred from the new CT, import the inference stack while the series is converted
+        threading.Thread(target=importlib.import_module, args=("bamf_nnunet_inference",), daemon=True).start()
+
+        converter = DicomToNiiConverter()
+        index, series_uid = get_series()
+        with atomic_output(temp_ct_path) as tmp_ct_path:
+            if not converter.dcm_to_nii(source_ct_dir, tmp_ct_path, dicom_index=index, series_uid=series_uid):
+                raise RuntimeError(f"failed to convert {source_ct_dir} to nifti")
+        write_geometry_sidecar(temp_ct_path, converter.geometry)
+        ingested["geometry"] = converter.geometry
+
+    pipeline.add_stage(
+        "dcm_to_nii",
+        convert_dcm_to_nii,
+        outputs=[temp_ct_path, get_sidecar_path(temp_ct_path)],
+        signature=get_series_signature
+        )
 
     #################################################
     # Infer using nnUNet model across all folds     #
-    # for Task775_CT_NSCLC_RG                       #
+    # for Task777_CT_Nodules and Task775_CT_NSCLC_RG#
     #################################################
-    organ_name_nsclc_rg_prefix = "ct_nsclc_rg_fold"
-    for fold_idx in range(num_folds):
-        organ_name_nsclc_rg_prefix_fold = f"{organ_name_nsclc_rg_prefix}_{fold_idx}"
-        context = {
-            'checkpoint_path': model_path_nsclc_rg,
-            'input_file': temp_ct_path,
-            'pt_file': None,
-            'prediction_save': temp_folds_dir,
-            'predict_aug': False,
-            'softmax': False,
-            'organ_name': organ_name_nsclc_rg_prefix_fold,
-            'fold': fold_idx,
-        }
-        context = DotDict(context)
-        print(f"inferring for fold {fold_idx} for task {TASK_NAME_NSCLC_RG}")
-        print(context)
-        # nnUNet creates below file internally. Format: temp_dir/ct_nsclc_rg_fold_0.nii.gz
-        output_seg_nii_file = f"{organ_name_nsclc_rg_prefix_fold}.nii.gz"
-        output_seg_nii_path = get_path(temp_folds_dir, output_seg_nii_file)
-        if not os.path.isfile(output_seg_nii_path):
-            nnunet_inference_model.handle(context=context)
+    tasks = get_tasks()
+    organ_name_nodules_prefix, organ_name_nsclc_rg_prefix = [organ_name_prefix for _, _, organ_name_prefix, _ in tasks]
+    if num_workers > 0:
+        units = [
+            {
+                "checkpoint_path": checkpoint_path,
+                "fold": fold_idx,
+                "input_file": temp_ct_path,
+                "prediction_save": temp_folds_dir,
+                "organ_name": f"{organ_name_prefix}_{fold_idx}",
+                "output_ext": intermediate_ext,
+                "network_space": network_space,
+                "quantized": precision == "int8",
+                "max_dice_drop": int8_max_dice_drop,
+                "accumulator_dtype": accumulator_dtype,
+                "spill_dir": spill_dir,
+                "use_bundle": use_model_bundles,
+                "is_nodules": is_nodules,
+            }
+            for _, checkpoint_path, organ_name_prefix, is_nodules in tasks
+            for fold_idx in range(num_folds)
+        ]
+        pipeline.add_stage(
+            "infer_folds",
+            lambda _: infer_folds_parallel(
+                units, temp_folds_dir, organ_label, num_workers, threads_per_worker, fold_ext,
+                slab_size=slab_size, spill_dir=spill_dir,
+                on_inference_start=lambda: stage_timer.mark_once("time_to_first_voxel", start_time)
+                ),
+            outputs=[path for unit in units for path in get_fold_outputs(unit["organ_name"])],
+            deps=["dcm_to_nii"],
+            signature=lambda: [get_fold_signature(unit) for unit in units]
+            )
+        fold_stages = {organ_name_prefix: ["infer_folds"] for _, _, organ_name_prefix, _ in tasks}
+    else:
+        # the folds share one device, so they are inferred one at a time; only the other
+        # stages (ensembles, SEG exports) overlap with them
+        inference_lock = threading.Lock()
+
+        def infer_fold(task_name, checkpoint_path, context):
+            def fn(_):
+                with inference_lock:
+                    print(f"inferring for fold {context.fold} for task {task_name}")
+                    print(context)
+                    with get_model_cache().acquire(checkpoint_path, context.fold) as nnunet_inference_model:
+                        nnunet_inference_model.handle(context=context)
+            return fn
+
+        # every fold is its own stage, folds of both tasks are independent of each other
+        fold_stages = {organ_name_prefix: [] for _, _, organ_name_prefix, _ in tasks}
+        for task_name, checkpoint_path, organ_name_prefix, _ in tasks:
+            for fold_idx in range(num_folds):
+                organ_name_prefix_fold = f"{organ_name_prefix}_{fold_idx}"
+                context = {
+                    'checkpoint_path': checkpoint_path,
+                    'input_file': temp_ct_path,
+                    'pt_file': None,
+                    'prediction_save': temp_folds_dir,
+                    'predict_aug': False,
+                    'softmax': False,
+                    'organ_name': organ_name_prefix_fold,
+                    'fold': fold_idx,
+                    'output_ext': intermediate_ext,
+                    'network_space': network_space,
+                    'quantized': precision == "int8",
+                    'max_dice_drop': int8_max_dice_drop,
+                    'accumulator_dtype': accumulator_dtype,
+                    'spill_dir': spill_dir,
+                    'use_bundle': use_model_bundles,
+                    'on_inference_start': lambda: stage_timer.mark_once("time_to_first_voxel", start_time),
+                }
+                context = DotDict(context)
+                # nnUNet creates below file internally. Format: temp_dir/ct_nodules_fold_0.nii
+                pipeline.add_stage(
+                    f"infer_{organ_name_prefix_fold}",
+                    infer_fold(task_name, checkpoint_path, context),
+                    outputs=get_fold_outputs(organ_name_prefix_fold),
+                    deps=["dcm_to_nii"],
+                    signature=lambda context=context: get_fold_signature(context)
+                    )
+                fold_stages[organ_name_prefix].append(f"infer_{organ_name_prefix_fold}")
+
+    postprocessing_deps = list(dict.fromkeys(stage for stages in fold_stages.values() for stage in stages))
+    if network_space:
+        def ensemble_task(organ_name_prefix, is_nodules):
+            return lambda results: ensemble_on_network_grid(
+                temp_folds_dir, organ_name_prefix, is_nodules, organ_label, num_folds, intermediate_ext,
+                fold_votes=results.get("infer_folds"), slab_size=slab_size
+                )
+
+        # the folds of a task are ensembled as soon as they are all in
+        postprocessing_deps = []
+        for _, _, organ_name_prefix, is_nodules in tasks:
+            pipeline.add_stage(
+                f"ensemble_{organ_name_prefix}",
+                ensemble_task(organ_name_prefix, is_nodules),
+                outputs=[get_path(temp_folds_dir, f"{organ_name_prefix}_ensemble{intermediate_ext}")],
+                deps=fold_stages[organ_name_prefix],
+                signature=lambda: {"organ_label": organ_label, "num_folds": num_folds}
+                )
+            postprocessing_deps.append(f"ensemble_{organ_name_prefix}")
 
     # ensemble and post process
-    lung_post_processor = LungPostProcessor()
     # out_file_path_nii_final = get_path(temp_folds_dir, output_seg_name)
     output_nodules_seg_path = get_path(temp_folds_dir, output_nodules_seg_name)
     output_lesions_seg_path = get_path(temp_folds_dir, output_lesions_seg_name)
-    lung_post_processor.postprocessing(
-        save_path=temp_folds_dir,
-        ct_path=temp_ct_path,
-        output_nodules_seg_path=output_nodules_seg_path,
-        output_lesions_seg_path=output_lesions_seg_path,
-        organ_name_nodules_prefix=organ_name_nodules_prefix,
-        organ_name_nsclc_rg_prefix=organ_name_nsclc_rg_prefix,        
-        lung_label=organ_label
+
+    def postprocess(results):
+        from lung_processor import LungPostProcessor
+
+        lung_post_processor = LungPostProcessor()
+        lung_post_processor.postprocessing(
+            save_path=temp_folds_dir,
+            ct_path=temp_ct_path,
+            output_nodules_seg_path=output_nodules_seg_path,
+            output_lesions_seg_path=output_lesions_seg_path,
+            organ_name_nodules_prefix=organ_name_nodules_prefix,
+            organ_name_nsclc_rg_prefix=organ_name_nsclc_rg_prefix,
+            lung_label=organ_label,
+            num_folds=num_folds,
+            fold_votes=results.get("infer_folds"),
+            ct_geometry=ingested.get("geometry"),
+            fold_ext=intermediate_ext,
+            network_ensemble=network_space,
+            slab_size=slab_size,
+            spill_dir=spill_dir
+            )
+
+    pipeline.add_stage(
+        "postprocessing",
+        postprocess,
+        outputs=[
+            path
+            for seg_path in [output_nodules_seg_path, output_lesions_seg_path]
+            for path in [seg_path, get_lesion_table_path(seg_path, "json"), get_lesion_table_path(seg_path, "csv")]
+        ],
+        deps=postprocessing_deps,
+        signature=lambda: {"organ_label": organ_label, "num_folds": num_folds}
         )
 
     #################################################
     # Convert Nifties back to dcm                   #
     #################################################
-    dcmqi_package_path = os.environ["DCMQI_PACKAGE_PATH"]
-    converter = NiiToDicomConverter(dcmqi_package_path)
+    # the nodules and lesions SEGs are converted concurrently
+    for seg_kind, seg_path, seg_name in [
+        ("nodules", output_nodules_seg_path, output_nodules_seg_name),
+        ("lesions", output_lesions_seg_path, output_lesions_seg_name),
+    ]:
+        pipeline.add_stage(
+            f"export_{seg_kind}_seg",
+            lambda _, seg_path=seg_path, seg_name=seg_name: export_seg(
+                seg_path, seg_name, source_ct_dir, target_dir, dcm_ref_files=get_series_files()
+                ),
+            deps=["postprocessing"],
+            # the SEG goes to target_dir, a rerun into another dir has to write it there again
+            signature=lambda seg_name=seg_name: {"target_dir": str(target_dir), "seg_name": seg_name}
+            )
 
-    # convert nii output back to dcm for Task777_CT_Nodules
-    # Example output_nodules_seg_name: "seg_nodules_ensemble.nii.gz" 
-    output_nodules_seg_name_dcm = output_nodules_seg_name.split('.')[0].strip() + ".dcm"
-    target_segmented_dcm_file = get_path(target_dir, output_nodules_seg_name_dcm)
-    nodules_success = converter.convert_nii_to_dcm(
-        nii_path=Path(output_nodules_seg_path),
-        dcm_ref_dir=Path(source_ct_dir),
-        dcm_out_file=Path(target_segmented_dcm_file),
-        dicom_seg_meta_json=Path("dicom_seg_meta.json"),
-        add_background_label=False
-    )
-    # Safety check: If dicom conversion fails, ship the nii file
-    if not nodules_success:
-        target_segmented_nii_file = get_path(target_dir, output_nodules_seg_name)
-        shutil.copyfile(output_nodules_seg_path, target_segmented_nii_file)
-    print("Execution of nodules segmentation complete!")
-
-    # convert nii output back to dcm for Task775_CT_NSCLC_RG
-    # Example output_lesions_seg_name: "seg_lesions_ensemble.nii.gz"     
-    output_lesions_seg_name_dcm = output_lesions_seg_name.split('.')[0].strip() + ".dcm"
-    target_segmented_dcm_file = get_path(target_dir, output_lesions_seg_name_dcm)
-    lesions_success = converter.convert_nii_to_dcm(
-        nii_path=Path(output_lesions_seg_path),
-        dcm_ref_dir=Path(source_ct_dir),
-        dcm_out_file=Path(target_segmented_dcm_file),
-        dicom_seg_meta_json=Path("dicom_seg_meta.json"),
-        add_background_label=False
-    )
-    # Safety check: If dicom conversion fails, ship the nii file
-    if not lesions_success:
-        target_segmented_nii_file = get_path(target_dir, output_lesions_seg_name)
-        shutil.copyfile(output_lesions_seg_path, target_segmented_nii_file)
-    print("Execution of lesions segmentation complete!")
+    pipeline.run()
+    print("Execution of nodules and lesions segmentation complete!")
+    return stage_timer.timings
 
 
 if __name__ == "__main__":
@@ -157,27 +605,10 @@ if __name__ == "__main__":
     args = parser.parse_args()
     config_path = args.config
     config = load_config(config_path)
+    validate_config(config)
 
     # Load arguments from config
-    general = config.get("general", {})
-    data_base_dir = general.get("data_base_dir")
-    modules = config.get("modules", {})
-    nnunet_runner = modules.get("NNUnetRunner", {})
-    source_ct_dir = nnunet_runner.get("source_ct_dir")
-    source_ct_dir = os.path.join(data_base_dir, source_ct_dir)
-    target_dir = nnunet_runner.get("target_dir")
-    target_dir = os.path.join(data_base_dir, target_dir)
-    num_folds = int(nnunet_runner.get("num_folds"))
-    organ_label = int(nnunet_runner.get("organ_label"))
-    output_nodules_seg_name = nnunet_runner.get("output_nodules_seg_name")
-    output_lesions_seg_name = nnunet_runner.get("output_lesions_seg_name")
+    runner_args = get_runner_args(config)
 
     # Run the model
-    run_nnunet(
-        source_ct_dir=source_ct_dir,
-        target_dir=target_dir,
-        output_nodules_seg_name=output_nodules_seg_name,
-        output_lesions_seg_name=output_lesions_seg_name,
-        num_folds=5,
-        organ_label=organ_label
-        )
+    run_nnunet(**runner_args)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Score the AI segmentations of the QA cohort against the reviewer corrections.
+
+Vectorized counterpart of the metrics in model_performance.ipynb. Every DICOM SEG is
+decoded once into a label volume cache, then Dice, 95% Hausdorff distance, volume error
+and lesion level detection metrics are computed for all series in parallel.
+"""
+import argparse
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pydicom
+import pydicom_seg
+import SimpleITK as sitk
+from scipy import ndimage
+
+LABELS = {"lung": 1, "tumor": 2}
+# 26-connectivity, same as skimage.measure.label used in the notebook
+CONNECTIVITY = ndimage.generate_binary_structure(3, 3)
+
+
+def load_qa_results(qa_dir: Path) -> pd.DataFrame:
+    """Load qa-results.csv and resolve the AI and reference segmentation of every review"""
+    df = pd.read_csv(
+        qa_dir / "qa-results.csv",
+        dtype={
+            "PatientID": str,
+            "StudyDate": str,
+            "StudyDate_suffix": str,
+            "LikertScore": int,
+        },
+    )
+    df["CorrectedSegmentation"] = df["CorrectedSegmentation"].fillna("")
+    return df
+
+
+def resolve_seg_files(df: pd.DataFrame, qa_dir: Path, ai_seg_dir: Path) -> pd.DataFrame:
+    """
+    Add ai_seg_file and qa_seg_file columns. Reviews without a correction (Likert score 5)
+    are compared against the AI segmentation itself, as in the notebook.
+    """
+    df = df.copy()
+    df["ai_seg_file"] = [str(ai_seg_dir / x) for x in df["AISegmentation"]]
+    corrected = (df["LikertScore"] < 5) & (df["CorrectedSegmentation"] != "")
+    df["qa_seg_file"] = np.where(
+        corrected,
+        [str(qa_dir / "qa-segmentations-dcm" / x) for x in df["CorrectedSegmentation"]],
+        df["ai_seg_file"],
+    )
+    return df
+
+
+class MaskCache:
+    """
+    On-disk cache of decoded segmentations. Each SEG (or nifti) is stored as a uint8 label
+    volume together with its geometry, so it only has to be decoded once per cohort.
+
+    Args:
+        cache_dir (Path): directory holding the decoded .npz files
+    """
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _cache_path(self, seg_path: Path) -> Path:
+        stat = os.stat(seg_path)
+        key = f"{Path(seg_path).resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+        return self.cache_dir / (hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npz")
+
+    @staticmethod
+    def _decode(seg_path: Path) -> sitk.Image:
+        if Path(seg_path).suffix == ".dcm":
+            dcm = pydicom.dcmread(str(seg_path))
+            result = pydicom_seg.MultiClassReader().read(dcm)
+            return sitk.Cast(result.image, sitk.sitkUInt8)
+        return sitk.Cast(sitk.ReadImage(str(seg_path)), sitk.sitkUInt8)
+
+    def add(self, seg_path: Path) -> Path:
+        """Decode seg_path unless it is cached already. Returns the cache file."""
+        cache_path = self._cache_path(seg_path)
+        if cache_path.exists():
+            return cache_path
+        img = self._decode(seg_path)
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp.npz")
+        np.savez(
+            tmp_path,
+            labels=sitk.GetArrayFromImage(img),
+            spacing=np.array(img.GetSpacing()),
+            origin=np.array(img.GetOrigin()),
+            direction=np.array(img.GetDirection()),
+        )
+        os.replace(tmp_path, cache_path)
+        return cache_path
+
+    def get(self, seg_path: Path) -> sitk.Image:
+        with np.load(self.add(seg_path)) as f:
+            img = sitk.GetImageFromArray(f["labels"])
+            img.SetSpacing(tuple(f["spacing"]))
+            img.SetOrigin(tuple(f["origin"]))
+            img.SetDirection(tuple(f["direction"]))
+        return img
+
+
+def same_geometry(img: sitk.Image, ref_img: sitk.Image) -> bool:
+    return (
+        img.GetSize() == ref_img.GetSize()
+        and np.allclose(img.GetSpacing(), ref_img.GetSpacing())
+        and np.allclose(img.GetOrigin(), ref_img.GetOrigin())
+        and np.allclose(img.GetDirection(), ref_img.GetDirection())
+    )
+
+
+def resize_label(img: sitk.Image, ref_img: sitk.Image) -> sitk.Image:
+    if same_geometry(img, ref_img):
+        return img
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetReferenceImage(ref_img)
+    resampler.SetInterpolator(sitk.sitkNearestNeighbor)
+    resampler.SetDefaultPixelValue(0)
+    return resampler.Execute(img)
+
+
+def _surface(mask: np.ndarray) -> np.ndarray:
+    return mask & ~ndimage.binary_erosion(mask, structure=CONNECTIVITY, border_value=0)
+
+
+def hausdorff_distance_95(pred: np.ndarray, gt: np.ndarray, spacing) -> float:
+    """
+    95th percentile of the symmetric surface distances, using distance transforms
+    restricted to the bounding box of both masks.
+    """
+    if not pred.any() or not gt.any():
+        return np.nan if not pred.any() and not gt.any() else np.inf
+    bbox = ndimage.find_objects((pred | gt).astype(np.uint8))[0]
+    # one voxel margin so the surfaces at the bounding box edge are kept
+    bbox = tuple(
+        slice(max(s.start - 1, 0), min(s.stop + 1, n)) for s, n in zip(bbox, pred.shape)
+    )
+    pred_surface = _surface(pred[bbox])
+    gt_surface = _surface(gt[bbox])
+    dist_to_gt = ndimage.distance_transform_edt(~gt_surface, sampling=spacing)
+    dist_to_pred = ndimage.distance_transform_edt(~pred_surface, sampling=spacing)
+    surface_dist = np.concatenate([dist_to_gt[pred_surface], dist_to_pred[gt_surface]])
+    return float(np.percentile(surface_dist, 95))
+
+
+def detection_metrics(pred: np.ndarray, gt: np.ndarray, vox_ml: float) -> dict:
+    """
+    Lesion level detection metrics. A predicted component is a true positive when it
+    overlaps the reference, a reference component is missed when nothing overlaps it.
+    """
+    pd_cc, n_pd = ndimage.label(pred, structure=CONNECTIVITY)
+    gt_cc, n_gt = ndimage.label(gt, structure=CONNECTIVITY)
+    pd_sizes = np.bincount(pd_cc.ravel(), minlength=n_pd + 1)[1:]
+    gt_sizes = np.bincount(gt_cc.ravel(), minlength=n_gt + 1)[1:]
+    pd_overlap = np.bincount(pd_cc[gt], minlength=n_pd + 1)[1:]
+    gt_overlap = np.bincount(gt_cc[pred], minlength=n_gt + 1)[1:]
+
+    true_vol_overlap_ml = pd_overlap[pd_overlap > 0] * vox_ml
+    false_pos_vols_ml = pd_sizes[pd_overlap == 0] * vox_ml
+    false_neg_vols_ml = gt_sizes[gt_overlap == 0] * vox_ml
+    return {
+        "true_vol_overlap_ml_total": float(true_vol_overlap_ml.sum()),
+        "false_pos_vol_ml_total": float(false_pos_vols_ml.sum()),
+        "false_neg_vol_ml_total": float(false_neg_vols_ml.sum()),
+        "true_vol_overlap_cnt": int(len(true_vol_overlap_ml)),
+        "false_pos_cnt": int(len(false_pos_vols_ml)),
+        "false_neg_cnt": int(len(false_neg_vols_ml)),
+    }
+
+
+def score_pair(ai_seg_file: str, qa_seg_file: str, cache_dir: str) -> list:
+    """
+    Compute the metrics of every label for one AI / reference pair.
+    """
+    cache = MaskCache(cache_dir)
+    ai_img = cache.get(ai_seg_file)
+    qa_img = resize_label(cache.get(qa_seg_file), ai_img)  # match the size of the ai_img
+    ai_arr = sitk.GetArrayFromImage(ai_img)
+    qa_arr = sitk.GetArrayFromImage(qa_img)
+    spacing = ai_img.GetSpacing()[::-1]  # numpy is reversed dimensions from sitk
+    vox_ml = float(np.prod(spacing)) / 1000
+
+    rows = []
+    for label_name, label_value in LABELS.items():
+        pred = ai_arr == label_value
+        gt = qa_arr == label_value
+        pred_vox = int(pred.sum())
+        gt_vox = int(gt.sum())
+        intersection = int(np.count_nonzero(pred & gt))
+        row = {
+            "ai_seg_file": ai_seg_file,
+            "qa_seg_file": qa_seg_file,
+            "Label": label_name,
+            "dice": 2 * intersection / (pred_vox + gt_vox) if pred_vox + gt_vox else np.nan,
+            "hausdorff_distance_95": hausdorff_distance_95(pred, gt, spacing),
+            "ai_vol_ml": pred_vox * vox_ml,
+            "qa_vol_ml": gt_vox * vox_ml,
+            "volume_error_ml": (pred_vox - gt_vox) * vox_ml,
+        }
+        if label_name == "tumor":
+            row.update(detection_metrics(pred, gt, vox_ml))
+        rows.append(row)
+    return rows
+
+
+def _decode_to_cache(seg_file: str, cache_dir: str) -> str:
+    return str(MaskCache(cache_dir).add(seg_file))
+
+
+def evaluate_cohort(df: pd.DataFrame, cache_dir: Path, num_workers: int = None) -> pd.DataFrame:
+    """
+    Score every review in df. Returns a tidy table with one row per review and label.
+    """
+    cache_dir = str(cache_dir)
+    seg_files = sorted(set(df["ai_seg_file"]) | set(df["qa_seg_file"]))
+    pairs = sorted(set(zip(df["ai_seg_file"], df["qa_seg_file"])))
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        # decode each SEG once, several reviews share the same AI segmentation
+        list(executor.map(_decode_to_cache, seg_files, [cache_dir] * len(seg_files)))
+        scored = executor.map(
+            score_pair, [p[0] for p in pairs], [p[1] for p in pairs], [cache_dir] * len(pairs)
+        )
+        metrics_df = pd.DataFrame([row for rows in scored for row in rows])
+    return df.merge(metrics_df, on=["ai_seg_file", "qa_seg_file"], how="left")
+
+
+def summarize_by_collection(series_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Aggregate the per-series metrics per collection, reviewer and label.
+    """
+    series_df = series_df.replace([np.inf, -np.inf], np.nan)
+    grouped = series_df.groupby(["Collection", "Reviewer", "Label"])
+    summary = grouped.agg(
+        n_series=("SeriesInstanceUID", "nunique"),
+        dice_mean=("dice", "mean"),
+        dice_std=("dice", "std"),
+        dice_median=("dice", "median"),
+        hausdorff_distance_95_mean=("hausdorff_distance_95", "mean"),
+        hausdorff_distance_95_median=("hausdorff_distance_95", "median"),
+        volume_error_ml_mean=("volume_error_ml", "mean"),
+        abs_volume_error_ml_mean=("volume_error_ml", lambda x: x.abs().mean()),
+    )
+    if "true_vol_overlap_cnt" in series_df:
+        counts = grouped[["true_vol_overlap_cnt", "false_pos_cnt", "false_neg_cnt"]].sum(min_count=1)
+        tp, fp, fn = counts["true_vol_overlap_cnt"], counts["false_pos_cnt"], counts["false_neg_cnt"]
+        summary = summary.join(counts)
+        summary["sensitivity"] = tp / (tp + fn)
+        summary["f1"] = 2 * tp / (2 * tp + fp + fn)
+    return summary.reset_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score the AI segmentations of the QA cohort")
+    parser.add_argument("--qa_dir", type=Path, default=Path("qa-results"), help="dir containing qa-results.csv")
+    parser.add_argument(
+        "--ai_seg_dir",
+        type=Path,
+        help="dir with the AI segmentations to score, defaults to qa_dir/ai-segmentations-dcm",
+    )
+    parser.add_argument("--cache_dir", type=Path, help="decoded mask cache, defaults to qa_dir/.mask-cache")
+    parser.add_argument("--output_dir", type=Path, default=Path("qa-results"), help="dir to write the tables to")
+    parser.add_argument("--num_workers", type=int, default=None, help="worker processes, defaults to all cores")
+    parser.add_argument("--validation_only", action="store_true", help="only score the validation subset")
+    args = parser.parse_args()
+
+    ai_seg_dir = args.ai_seg_dir or args.qa_dir / "ai-segmentations-dcm"
+    cache_dir = args.cache_dir or args.qa_dir / ".mask-cache"
+
+    df = load_qa_results(args.qa_dir)
+    if args.validation_only:
+        df = df[df["Validation"]]
+    df = resolve_seg_files(df, args.qa_dir, ai_seg_dir)
+
+    series_df = evaluate_cohort(df, cache_dir, num_workers=args.num_workers)
+    collection_df = summarize_by_collection(series_df)
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    series_df.to_csv(args.output_dir / "metrics-per-series.csv", index=False)
+    collection_df.to_csv(args.output_dir / "metrics-per-collection.csv", index=False)
+    print(collection_df.round(2).to_string(index=False))